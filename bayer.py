@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import numpy as np
+from toy_noise import linear_fit_batch
+from stack_stats import median_variance_bias
+
+def cfa_planes(image,origin=(0,0)):
+    """
+    Returns a view of the Bayer image with shape (2, 2, rows/2, cols/2),
+    without copying, where [i,j] is the plane of pixels at sensor rows and
+    columns with parity i and j. origin is the sensor position of image[0,0],
+    e.g. (1000,1000) for the image[1000:2024,1000:2024] ROI. An odd last row
+    or column is dropped.
+    """
+    n_rows = image.shape[-2]//2
+    n_cols = image.shape[-1]//2
+    image = image[...,:2*n_rows,:2*n_cols]
+    # splitting axes never needs a copy
+    planes = image.reshape(image.shape[:-2]+(n_rows,2,n_cols,2))
+    planes = np.moveaxis(planes,[-3,-1],[0,1])
+    if origin[0] % 2:
+        planes = planes[::-1]
+    if origin[1] % 2:
+        planes = planes[:,::-1]
+    return planes
+
+def plane_names(raw_pattern,color_desc):
+    """
+    Returns a 2x2 list of names of the CFA planes from the color indices of
+    the top-left 2x2 pixels of raw_image and rawpy's color_desc, e.g.
+    [["R","G1"],["G2","B"]]. Colors appearing twice are numbered in raster
+    order.
+    """
+    if isinstance(color_desc,bytes):
+        color_desc = color_desc.decode()
+    colors = [[color_desc[raw_pattern[i][j]] for j in range(2)] for i in range(2)]
+    flat = [colors[0][0],colors[0][1],colors[1][0],colors[1][1]]
+    result = []
+    for k, color in enumerate(flat):
+        if flat.count(color) > 1:
+            color += str(flat[:k].count(color)+1)
+        result.append(color)
+    return [result[:2],result[2:]]
+
+def read_cfa_layout(fn):
+    """
+    Returns the color indices of the top-left 2x2 pixels of raw_image (which,
+    unlike raw_pattern, includes the masked margins) and the color_desc of a
+    raw file.
+    """
+    import rawpy
+    with rawpy.imread(fn) as raw:
+        return raw.raw_colors[:2,:2].tolist(), raw.color_desc.decode()
+
+def plane_medians(image,origin=(0,0)):
+    """
+    Returns the 2x2 array of the medians of each CFA plane of image.
+    """
+    planes = cfa_planes(image,origin)
+    return np.median(planes.reshape((2,2,-1)),axis=-1)
+
+def summarize_cfa_medians(stats,origin=(0,0)):
+    """
+    Like calib_store.summarize_medians, but returns 2x2 lists with the
+    medians of each CFA plane. origin is the sensor position of the
+    accumulated frames' first pixel.
+    """
+    variance_img = stats.get_sample_variance()
+    bias = median_variance_bias(stats.n)
+    return {"n":stats.n,
+            "mean":plane_medians(stats.get_mean(),origin).tolist(),
+            "variance":(plane_medians(variance_img,origin)/bias).tolist(),
+            "std":(plane_medians(np.sqrt(variance_img),origin)/np.sqrt(bias)).tolist()}
+
+def ptc_fit_planes(x,y):
+    """
+    Least squares fits y = slope*x+intercept for every CFA plane at once.
+    y has shape (N,2,2), or any (N,...) shape, and x either the same shape,
+    e.g. each plane's own means, or (N,) if shared by all planes. Returns
+    slope, intercept, slope error, intercept error, y error, each with the
+    shape of y[0], like toy_noise.linear_fit.
+    """
+    y = np.asarray(y,dtype="float64")
+    x = np.asarray(x,dtype="float64")
+    if len(x) != len(y):
+        raise Exception("Length of x and y data must be the same!")
+    if x.ndim == 1:
+        x = x.reshape((len(x),)+(1,)*(y.ndim-1))
+    x = np.broadcast_to(x,y.shape)
+    results = linear_fit_batch(x.reshape((len(x),-1)).T,y.reshape((len(y),-1)).T)
+    return tuple(result.reshape(y.shape[1:]) for result in results)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import tempfile
+import tracemalloc
+import resource
+import numpy as np
+from simulate_sensor import SensorModel
+from investigate_bias import OnlineStatsCalc, get_stats, make_stats_and_frames
+from stack_stats import StackStatsCalc
+from calib_store import AccumulatorStore, summarize_medians
+from parallel_reduce import read_raw_frame
+from pair_ptc import pair_ptc
+from bayer import summarize_cfa_medians, ptc_fit_planes
+from dark_maps import dark_current_maps, HOT
+from toy_noise import linear_fit, linear_fit_batch
+
+def measure(func,*args,**kwargs):
+    """
+    Returns func(*args,**kwargs), its wall time in seconds and the peak
+    memory it allocated in this process (worker processes aren't traced,
+    see children_max_rss).
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args,**kwargs)
+    elapsed = time.perf_counter()-start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+def children_max_rss():
+    """
+    Returns the largest resident set size of any finished worker process so
+    far, in bytes.
+    """
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss*1024
+
+def report_header():
+    print(f"{'benchmark':24} {'size':>11} {'frames':>6} {'time [s]':>9} {'frames/s':>9} {'MP/s':>9} {'peak [MB]':>9}")
+
+def report(name,shape,n_frames,elapsed,peak):
+    megapixels = shape[0]*shape[1]/1e6
+    size = f"{shape[0]}x{shape[1]}"
+    print(f"{name:24} {size:>11} {n_frames:6d} {elapsed:9.3f} {n_frames/elapsed:9.2f} "
+          f"{n_frames*megapixels/elapsed:9.2f} {peak/2**20:9.1f}",flush=True)
+
+def check(name,recovered,truth,tolerance):
+    error = recovered/truth-1
+    status = "ok" if abs(error) <= tolerance else "FAIL"
+    print(f"    {name:28} recovered {recovered:10.4g} truth {truth:10.4g} error {100*error:+6.2f}% {status}")
+    return abs(error) <= tolerance
+
+def bench_stack_stats(sensor,n_frames):
+    frames = sensor.stack(n_frames,1.,flux=100.)
+    def online():
+        stats = OnlineStatsCalc(sensor.shape)
+        for frame in frames:
+            stats.add_sample(frame)
+        return stats
+    def chunked():
+        stats = StackStatsCalc(sensor.shape)
+        stats.add_samples(frames)
+        return stats.get_mean()
+    for name, func in [("OnlineStatsCalc",online),("StackStatsCalc",chunked)]:
+        result, elapsed, peak = measure(func)
+        report(name,sensor.shape,n_frames,elapsed,peak)
+
+def bench_frame_stats(sensor,workdir):
+    frame = sensor.frame(1.,flux=100.)
+    result, elapsed, peak = measure(get_stats,frame)
+    report("get_stats",sensor.shape,1,elapsed,peak)
+    result, elapsed, peak = measure(make_stats_and_frames,frame,os.path.join(workdir,"bench_frame"))
+    report("make_stats_and_frames",sensor.shape,1,elapsed,peak)
+
+def bench_linear_fit(n_series=10**6,n_points=10):
+    rng = np.random.default_rng(0)
+    x = np.arange(n_points,dtype="float64")
+    y = 2*x+1+rng.standard_normal((n_series,n_points))
+    n_loop = min(n_series,1000)
+    result, elapsed, peak = measure(lambda: [linear_fit(x,y[i],printinfo=False) for i in range(n_loop)])
+    print(f"{'linear_fit':24} {n_loop:8d} fits {elapsed:9.3f} s {n_loop/elapsed:12.0f} fits/s")
+    result, elapsed, peak = measure(linear_fit_batch,x,y)
+    print(f"{'linear_fit_batch':24} {n_series:8d} fits {elapsed:9.3f} s {n_series/elapsed:12.0f} fits/s {peak/2**20:9.1f} MB")
+
+def bench_find_gain(sensor,n_frames,workdir,tolerance=0.02):
+    """
+    Simulates a flat field sweep and runs find_gain.py's reductions on it:
+    the accumulator store update and median summaries plus fit, and the
+    pair difference fit. Returns True if both recover the gain of every
+    CFA plane.
+    """
+    exposures = [0.5,1,2,3,4,5,6,7]
+    # keep the brightest exposure at about 2/3 of full well
+    flux = 0.66*(sensor.white_level-2048)/sensor.gain/max(exposures)
+    groups = {}
+    for exposure in exposures:
+        dirname = os.path.join(workdir,f"walldata/ISO100/shutter{exposure:g}")
+        groups[dirname] = sensor.write_frames(dirname,n_frames,exposure,flux)
+    store = AccumulatorStore(os.path.join(workdir,"calib/walldata"))
+    def stack_method():
+        store.update(groups,reader=read_raw_frame)
+        summaries = [store.summary(key,summarize_medians) for key in groups]
+        pooled = linear_fit([s["mean"] for s in summaries],[s["variance"] for s in summaries],printinfo=False)[0]
+        summaries = [store.summary(key,summarize_cfa_medians) for key in groups]
+        planes = ptc_fit_planes([s["mean"] for s in summaries],[s["variance"] for s in summaries])[0]
+        return pooled, planes
+    def pair_method():
+        points = pair_ptc(groups)
+        return linear_fit([points[key]["mean"] for key in groups],[points[key]["variance"] for key in groups],printinfo=False)[0]
+    (pooled, planes), elapsed, peak = measure(stack_method)
+    report("find_gain stack",sensor.shape,n_frames*len(exposures),elapsed,max(peak,children_max_rss()))
+    # medians over planes of different response don't follow the PTC, so
+    # the pooled fit isn't an estimate of the gain and only the per-plane
+    # gains are checked
+    print(f"    {'pooled stack fit slope':28} {pooled:10.4g} (mixes CFA planes, not a gain estimate)")
+    ok = all([check(f"{name} stack gain [ADU/e-]",gain,sensor.gain,tolerance)
+              for name, gain in zip(["R","G1","G2","B"],planes.reshape(-1))])
+    gain, elapsed, peak = measure(pair_method)
+    report("find_gain pairs",sensor.shape,2*len(exposures),elapsed,max(peak,children_max_rss()))
+    return check("pair gain [ADU/e-]",gain,sensor.gain,tolerance) and ok
+
+def bench_find_noise(sensor,n_frames,workdir,tolerance=0.02):
+    """
+    Simulates a dark sweep and runs find_noise.py's reductions on it: the
+    median summaries and variance against exposure fit, and the per-pixel
+    dark current maps. Returns True if read noise, dark current and the hot
+    pixels are recovered. The measured read noise includes the 1/12 ADU^2
+    of rounding to integer ADUs.
+    """
+    exposures = [1/4000,1,2,4,8,15,30]
+    groups = {}
+    for exposure in exposures:
+        dirname = os.path.join(workdir,f"darkdata/ISO100/{exposure:g}")
+        groups[exposure] = sensor.write_frames(dirname,n_frames,exposure)
+    store = AccumulatorStore(os.path.join(workdir,"calib/darkdata"))
+    def reduce_darks():
+        store.update(groups,reader=read_raw_frame)
+        variances = [store.summary(key,summarize_medians)["variance"] for key in groups]
+        return linear_fit(exposures,variances,printinfo=False)
+    fit_results, elapsed, peak = measure(reduce_darks)
+    report("find_noise",sensor.shape,n_frames*len(exposures),elapsed,max(peak,children_max_rss()))
+    ok = check("read noise [ADU]",np.sqrt(fit_results[1]),np.sqrt((sensor.gain*sensor.read_noise)**2+1/12),tolerance)
+    prefix = os.path.join(workdir,"calib/dark_maps/iso100")
+    (flags, bad), elapsed, peak = measure(dark_current_maps,[store.mean_path(key) for key in groups],exposures,prefix)
+    report("dark_current_maps",sensor.shape,len(exposures),elapsed,max(peak,children_max_rss()))
+    dark_current = np.median(np.load(prefix+"_dark_current.npy",mmap_mode="r"))
+    ok = check("dark current [ADU/s]",dark_current,sensor.gain*np.median(sensor.dark_current_map),tolerance) and ok
+    n_hot = len(sensor.hot_pixels[0])
+    found = np.count_nonzero(flags[sensor.hot_pixels] & HOT)
+    print(f"    {'hot pixels':28} found {found} of {n_hot}, {np.count_nonzero(flags & HOT)-found} false")
+    return ok and found == n_hot
+
+if __name__ == "__main__":
+
+    sizes = [(512,768),(1024,1536)]
+    frame_counts = [16,32]
+    all_ok = True
+    bench_linear_fit()
+    for shape in sizes:
+        sensor = SensorModel(shape)
+        with tempfile.TemporaryDirectory() as workdir:
+            report_header()
+            bench_frame_stats(sensor,workdir)
+            for n_frames in frame_counts:
+                bench_stack_stats(sensor,n_frames)
+        for n_frames in frame_counts:
+            with tempfile.TemporaryDirectory() as workdir:
+                all_ok = bench_find_gain(sensor,n_frames,workdir) and all_ok
+                all_ok = bench_find_noise(sensor,n_frames,workdir) and all_ok
+    print("All ground truth checks passed" if all_ok else "Some ground truth checks FAILED")
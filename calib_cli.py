@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+"""
+Single entry point for the calibration scripts:
+
+    calib_cli.py capture --sweep dark -N 10
+    calib_cli.py bias --isos 800 1600
+    calib_cli.py gain --isos 100 200 --roi 1000:2024,1000:2024
+    calib_cli.py noise --isos 100 200 --dark-maps
+    calib_cli.py calibrate LIGHT/*.cr2 --isos 100 --flat flat.npy
+
+Only argparse is imported at startup; each subcommand imports the modules
+(and through them rawpy, pyexiv2, gphoto2...) it needs, and matplotlib,
+with the non-interactive Agg backend, only if plots are requested, so
+batch jobs can run many small invocations cheaply.
+"""
+
+import argparse
+
+ISOS = [100,200,400,800,1600]
+ROI = "1000:2024,1000:2024"
+
+def parse_roi(text):
+    """
+    Returns the (rows, columns) slices of text like "1000:2024,1000:2024".
+    """
+    try:
+        rows, columns = text.split(",")
+        return tuple(slice(*[int(x) for x in bounds.split(":")]) for bounds in [rows,columns])
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"ROI must be r0:r1,c0:c1, not {text!r}")
+
+def use_agg(plot):
+    if plot:
+        import matplotlib
+        matplotlib.use("Agg")
+
+def run_capture(args):
+    sweep_kwargs = {}
+    if args.sweep == "flat":
+        sweep_kwargs = {"plan":args.plan,"pairs":args.pairs}
+    if args.all_cameras:
+        from take_data import take_dark_data, take_flat_data
+        from multi_camera import run_sweeps
+        sweep = take_flat_data if args.sweep == "flat" else take_dark_data
+        results = run_sweeps(sweep,args.N,outdir=args.root,**sweep_kwargs)
+        return 1 if any(result is not None for result in results.values()) else 0
+    from take_data import Camera, take_dark_data, take_flat_data
+    from stage_timer import StageTimer
+    timer = StageTimer()
+    if args.simulate:
+        from simulated_camera import SimulatedCamera
+        flux = 20000. if args.sweep == "flat" else 0.
+        camera = Camera(backend=SimulatedCamera(flux=flux,time_scale=args.time_scale),timer=timer)
+    else:
+        camera = Camera(timer=timer)
+    if args.sweep == "flat":
+        take_flat_data(camera,args.N,root=args.root,**sweep_kwargs)
+    else:
+        take_dark_data(camera,args.N,root=args.root)
+    print(timer.report())
+    if args.timing_log:
+        timer.write_log(args.timing_log)
+    return 0
+
+def run_bias(args):
+    use_agg(args.plot)
+    from investigate_bias import make_master_frames
+    make_master_frames(args.isos,args.bias_dir,args.dark_dir,args.tiled,args.combine,plot=args.plot)
+    return 0
+
+def run_gain(args):
+    use_agg(args.plot)
+    from find_gain import find_gain
+    find_gain(args.isos,args.roi,args.walldata,args.pair_difference,args.subtract_bias,args.bias_dir,args.gain_file,args.plot)
+    return 0
+
+def run_noise(args):
+    use_agg(args.plot)
+    from find_noise import find_noise
+    find_noise(args.isos,args.roi,args.darkdata,args.dark_maps,args.gain_file,args.plot)
+    return 0
+
+def run_calibrate(args):
+    from calibrate import calibrate
+    outfns = calibrate(args.fns,args.isos,args.out_dir,args.flat,args.gain_file,args.bias_dir,args.dtype,args.pedestal,args.workers)
+    return 0 if all(outfn is not None for outfn in outfns) else 1
+
+def make_parser():
+    parser = argparse.ArgumentParser(description="Camera sensor calibration")
+    subparsers = parser.add_subparsers(dest="command",required=True)
+
+    capture = subparsers.add_parser("capture",help="take a flat or dark sweep (take_data.py)")
+    capture.add_argument("--sweep",choices=["flat","dark"],default="dark")
+    capture.add_argument("-N",type=int,default=10,help="frames per setting")
+    capture.add_argument("--root",default=".",help="directory to write walldata/ or darkdata/ under")
+    capture.add_argument("--plan",action="store_true",help="flats: only take the exposures an ExposurePlanner picks")
+    capture.add_argument("--pairs",action="store_true",help="flats: only take the two frames per exposure pair differences need")
+    capture.add_argument("--all-cameras",action="store_true",help="sweep every attached camera in parallel (multi_camera.py)")
+    capture.add_argument("--simulate",action="store_true",help="use a simulated camera instead of gphoto2")
+    capture.add_argument("--time-scale",type=float,default=0.1,help="simulated camera: fraction of real time to wait")
+    capture.add_argument("--timing-log",help="write the per-stage timings to this JSON lines file")
+    capture.set_defaults(func=run_capture)
+
+    bias = subparsers.add_parser("bias",help="build bias and dark master frames (investigate_bias.py)")
+    bias.add_argument("--bias-dir",default="BIAS")
+    bias.add_argument("--dark-dir",default="DARK")
+    bias.add_argument("--tiled",action="store_true",help="build master frames band by band, for sensors too big for memory")
+    bias.add_argument("--combine",choices=["median","sigma_clip","minmax"],help="combine frames rejecting outliers instead of a mean")
+    bias.set_defaults(func=run_bias)
+
+    gain = subparsers.add_parser("gain",help="fit the gain from flats (find_gain.py)")
+    gain.add_argument("--walldata",default="walldata")
+    gain.add_argument("--no-pairs",dest="pair_difference",action="store_false",help="skip the pair difference fit")
+    gain.add_argument("--no-bias-subtraction",dest="subtract_bias",action="store_false")
+    gain.add_argument("--bias-dir",default="BIAS")
+    gain.set_defaults(func=run_gain)
+
+    noise = subparsers.add_parser("noise",help="fit read noise and dark current from darks (find_noise.py)")
+    noise.add_argument("--darkdata",default="darkdata")
+    noise.add_argument("--dark-maps",action="store_true",help="also fit per-pixel dark current maps of the full frame")
+    noise.set_defaults(func=run_noise)
+
+    calibrate = subparsers.add_parser("calibrate",help="calibrate light frames (calibrate.py)")
+    calibrate.add_argument("fns",nargs="+",metavar="FILE",help="raw light frames")
+    calibrate.add_argument("--out-dir",default="calibrated")
+    calibrate.add_argument("--flat",help="master flat .npy")
+    calibrate.add_argument("--bias-dir",default="BIAS")
+    calibrate.add_argument("--dtype",choices=["float32","uint16"],default="float32")
+    calibrate.add_argument("--pedestal",type=float,default=0.,help="added before rounding to uint16")
+    calibrate.add_argument("--workers",type=int,help="worker processes, default one per CPU")
+    calibrate.set_defaults(func=run_calibrate)
+
+    for subparser in [bias,gain,noise,calibrate]:
+        subparser.add_argument("--isos",type=int,nargs="+",default=ISOS)
+    for subparser in [gain,noise]:
+        subparser.add_argument("--roi",type=parse_roi,default=parse_roi(ROI),help=f"r0:r1,c0:c1, default {ROI}")
+    for subparser in [gain,noise,calibrate]:
+        subparser.add_argument("--gain-file",default="gain.pkl")
+    for subparser in [bias,gain,noise]:
+        subparser.add_argument("--no-plots",dest="plot",action="store_false",help="skip matplotlib and all plots")
+    return parser
+
+if __name__ == "__main__":
+
+    args = make_parser().parse_args()
+    raise SystemExit(args.func(args))
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import json
+import hashlib
+import numpy as np
+from stack_stats import StackStatsCalc, median_variance_bias
+from parallel_reduce import reduce_groups, read_raw_frame
+
+# bumped whenever a summarize function changes, which drops stored summaries
+SUMMARY_VERSION = 2
+
+class AccumulatorStore:
+    """
+    Persistent per-group accumulators (n, mean, ss per pixel), so calibration
+    products can be updated as new frames arrive instead of recomputed.
+
+    Each group gets a directory under store_dir holding mean_<generation>.npy,
+    ss_<generation>.npy and state.json. The state lists the files merged so
+    far (with size and mtime), the generation of the arrays they add up to
+    and named summaries, e.g. the medians a script plots, so unchanged groups
+    don't even need their arrays loaded. An update writes the next
+    generation's arrays before atomically replacing the state, so a crash
+    leaves the previous arrays and state in use, never a mix of both.
+
+    update() only decodes files that haven't been merged yet and merges them
+    with the parallel variance formula. If a merged file changed or
+    disappeared, its contribution can't be taken back out, so that group is
+    rebuilt from scratch.
+    """
+
+    def __init__(self,store_dir):
+        self.store_dir = store_dir
+        os.makedirs(store_dir,exist_ok=True)
+
+    def group_dir(self,key):
+        name = re.sub(r"[^A-Za-z0-9]+","_",str(key)).strip("_")
+        return os.path.join(self.store_dir,name+"_"+hashlib.sha1(repr(key).encode()).hexdigest()[:8])
+
+    def _load_state(self,key):
+        try:
+            with open(os.path.join(self.group_dir(key),"state.json")) as infile:
+                state = json.load(infile)
+        except FileNotFoundError:
+            return {"key":repr(key),"n":0,"files":{},"summaries":{},"summary_version":SUMMARY_VERSION}
+        if state.get("summary_version") != SUMMARY_VERSION:
+            state["summaries"] = {}
+            state["summary_version"] = SUMMARY_VERSION
+        return state
+
+    def _array_path(self,key,state,name):
+        # stores from before generations were added have mean.npy and ss.npy
+        generation = state.get("generation")
+        filename = f"{name}.npy" if generation is None else f"{name}_{generation}.npy"
+        return os.path.join(self.group_dir(key),filename)
+
+    def _save_state(self,key,state):
+        dirname = self.group_dir(key)
+        tmp_path = os.path.join(dirname,"state.json.tmp")
+        with open(tmp_path,"w") as outfile:
+            json.dump(state,outfile,indent=1)
+        os.replace(tmp_path,os.path.join(dirname,"state.json"))
+
+    def update(self,groups,reader=read_raw_frame,**kwargs):
+        """
+        Merges the files of groups ({key: [file names]}) that aren't in the
+        store yet. kwargs are passed on to parallel_reduce.reduce_groups.
+        Files that can't be read aren't recorded, so they are retried next
+        time. Returns the set of keys whose accumulators changed.
+        """
+        to_reduce = {}
+        states = {}
+        currents = {}
+        old_paths = {}
+        for key in groups:
+            state = self._load_state(key)
+            old_paths[key] = [self._array_path(key,state,name) for name in ["mean","ss"]]
+            current = {}
+            for fn in groups[key]:
+                st = os.stat(fn)
+                current[fn] = [st.st_size,st.st_mtime_ns]
+            stale = [fn for fn in state["files"] if current.get(fn) != state["files"][fn]]
+            if len(stale) > 0:
+                print(f"Rebuilding {key}: {len(stale)} merged files changed or disappeared")
+                # the generation counts on, so the arrays in use aren't overwritten
+                state = {"key":repr(key),"n":0,"files":{},"summaries":{},"summary_version":SUMMARY_VERSION,
+                         "generation":state.get("generation",0)}
+            new_fns = [fn for fn in groups[key] if not (fn in state["files"])]
+            if len(new_fns) > 0:
+                to_reduce[key] = new_fns
+                states[key] = state
+                currents[key] = current
+        partials = reduce_groups(to_reduce,reader=reader,**kwargs)
+        changed = set()
+        for key in to_reduce:
+            partial, read_fns = partials[key]
+            if partial is None:
+                continue
+            state = states[key]
+            state["files"].update({fn:currents[key][fn] for fn in read_fns})
+            dirname = self.group_dir(key)
+            os.makedirs(dirname,exist_ok=True)
+            stats = None
+            if state["n"] > 0:
+                stats = StackStatsCalc.from_arrays(state["n"],np.load(self._array_path(key,state,"mean")),
+                                                   np.load(self._array_path(key,state,"ss")))
+            if stats is None:
+                stats = partial
+            else:
+                stats.merge(partial)
+            state["generation"] = state.get("generation",0)+1
+            np.save(self._array_path(key,state,"mean"),stats.get_mean())
+            np.save(self._array_path(key,state,"ss"),stats.ss)
+            state["n"] = stats.n
+            state["summaries"] = {}
+            self._save_state(key,state)
+            new_paths = [self._array_path(key,state,name) for name in ["mean","ss"]]
+            for path in old_paths[key]:
+                if os.path.exists(path) and not (path in new_paths):
+                    os.remove(path)
+            changed.add(key)
+        return changed
+
+    def mean_path(self,key):
+        """
+        Returns the path of the group's current per-pixel mean frame, a .npy
+        file. The next update of the group writes a new one.
+        """
+        return self._array_path(key,self._load_state(key),"mean")
+
+    def count(self,key):
+        """
+        Returns the number of frames accumulated for the group.
+        """
+        return self._load_state(key)["n"]
+
+    def load(self,key):
+        """
+        Returns the group's accumulator, with its arrays memory mapped
+        read-only, or None if the group has no frames.
+        """
+        state = self._load_state(key)
+        if state["n"] == 0:
+            return None
+        return StackStatsCalc.from_arrays(state["n"],
+                np.load(self._array_path(key,state,"mean"),mmap_mode="r"),
+                np.load(self._array_path(key,state,"ss"),mmap_mode="r"))
+
+    def get_summary(self,key,name):
+        return self._load_state(key)["summaries"].get(name)
+
+    def set_summary(self,key,name,summary):
+        """
+        Stores a JSON-serializable summary for the group under name; all
+        summaries are cleared whenever the group changes.
+        """
+        state = self._load_state(key)
+        state["summaries"][name] = summary
+        os.makedirs(self.group_dir(key),exist_ok=True)
+        self._save_state(key,state)
+
+    def summary(self,key,summarize,name=None):
+        """
+        Returns the group's summary called name (by default summarize's
+        __name__), first computing and storing it as summarize(accumulator)
+        if the group changed since it was last stored.
+        """
+        if name is None:
+            name = summarize.__name__
+        result = self.get_summary(key,name)
+        if result is None:
+            result = summarize(self.load(key))
+            self.set_summary(key,name,result)
+        return result
+
+def summarize_medians(stats):
+    """
+    Returns the medians over pixels of the mean, variance and standard
+    deviation frames, as plotted by find_gain.py and find_noise.py. The
+    variance and standard deviation are divided by median_variance_bias
+    (and its square root), so they estimate the typical pixel's noise.
+    """
+    variance_img = stats.get_sample_variance()
+    bias = median_variance_bias(stats.n)
+    return {"n":stats.n,
+            "mean":float(np.median(stats.get_mean())),
+            "variance":float(np.median(variance_img))/bias,
+            "std":float(np.median(np.sqrt(variance_img)))/np.sqrt(bias)}
+
+def roi_label(roi):
+    """
+    Returns a name for the (rows, columns) slices roi usable in a store
+    directory name, e.g. "roi1000-2024_1000-2024", so accumulators of
+    different ROIs are never mixed.
+    """
+    return f"roi{roi[0].start}-{roi[0].stop}_{roi[1].start}-{roi[1].stop}"
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+import os
+import glob
+import json
+import pickle
+import concurrent.futures
+import numpy as np
+from bayer import cfa_planes, plane_names, plane_medians
+from frame_index import FrameIndex
+from calib_store import AccumulatorStore
+
+class CalibrationMasters:
+    """
+    The calibration products for one ISO, as .npy paths: a master bias
+    frame, a dark current map in ADU/s (dark_maps.dark_current_maps with no
+    gain) and a master flat (bias included), plus gain in ADU/e-, either
+    pooled or as {CFA plane name: gain} in plane_gains. Anything left as
+    None is skipped.
+
+    The masters are memory mapped read-only when first used, so every worker
+    process shares one copy in the page cache, and are dropped when pickled.
+    """
+
+    def __init__(self,bias=None,dark_current=None,flat=None,gain=None,plane_gains=None):
+        self.bias = bias
+        self.dark_current = dark_current
+        self.flat = flat
+        self.gain = gain
+        self.plane_gains = plane_gains
+        self._arrays = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+    def flat_norm_path(self):
+        return None if self.flat is None else self.flat[:-len(".npy")]+"_norm.npy"
+
+    def prepare(self):
+        """
+        Writes the bias-subtracted flat, with each CFA plane divided by its
+        median, next to the flat as float32, unless it is already up to date.
+        """
+        if self.flat is None:
+            return
+        norm_path = self.flat_norm_path()
+        inputs = [fn for fn in [self.flat,self.bias] if fn is not None]
+        if os.path.exists(norm_path) and all(os.path.getmtime(fn) <= os.path.getmtime(norm_path) for fn in inputs):
+            return
+        flat = np.load(self.flat,mmap_mode="r").astype("float32")
+        if self.bias is not None:
+            flat -= np.load(self.bias,mmap_mode="r")
+        planes = cfa_planes(flat)
+        planes /= plane_medians(flat)[:,:,np.newaxis,np.newaxis]
+        tmp_path = f"{norm_path}.{os.getpid()}.tmp"
+        with open(tmp_path,"wb") as tmp_file:
+            np.save(tmp_file,flat)
+        os.replace(tmp_path,norm_path)
+
+    def signature(self):
+        """
+        Returns a JSON-serializable description of the masters, with the
+        files' modification times, which changes whenever a master is
+        rebuilt or a gain changes.
+        """
+        files = {}
+        for name, fn in [("bias",self.bias),("dark_current",self.dark_current),("flat",self.flat)]:
+            files[name] = None if fn is None else [fn,os.stat(fn).st_mtime_ns]
+        gain = None if self.gain is None else float(self.gain)
+        plane_gains = None
+        if self.plane_gains is not None:
+            plane_gains = {name:float(gain) for name, gain in self.plane_gains.items()}
+        return {"files":files,"gain":gain,"plane_gains":plane_gains}
+
+    def arrays(self):
+        if self._arrays is None:
+            self._arrays = {}
+            for name, fn in [("bias",self.bias),("dark_current",self.dark_current),("flat",self.flat_norm_path())]:
+                if fn is not None:
+                    self._arrays[name] = np.load(fn,mmap_mode="r")
+        return self._arrays
+
+def default_masters(iso,flat=None,gain_file="gain.pkl",bias_dir="BIAS"):
+    """
+    Returns the CalibrationMasters for iso from what this project's scripts
+    write: the shortest-exposure master bias from investigate_bias.py, the
+    dark current map from find_noise.py's dark_maps mode and gain.pkl from
+    find_gain.py, each if present. flat is the path of a master flat.
+    """
+    bias = None
+    prefix = os.path.join(bias_dir,"")
+    shutter_speeds = FrameIndex().fns_by_iso_shutter_speed(isos=[int(iso)],prefix=prefix).get(int(iso),{})
+    if len(shutter_speeds) > 0:
+        store = AccumulatorStore("calib/BIAS")
+        key = (int(iso),min(shutter_speeds))
+        if store.load(key) is not None:
+            bias = store.mean_path(key)
+    dark_current = f"calib/dark_maps/iso{iso}_dark_current.npy"
+    if not os.path.exists(dark_current):
+        dark_current = None
+    gain = None
+    plane_gains = None
+    try:
+        with open(gain_file,"rb") as infile:
+            gains = pickle.load(infile)
+        if str(iso) in gains:
+            gain = gains[str(iso)]["gain"]
+            if "planes" in gains[str(iso)]:
+                plane_gains = {name:plane["gain"] for name, plane in gains[str(iso)]["planes"].items()}
+    except FileNotFoundError as e:
+        print("Warning: Couldn't open gain file: ",e)
+    return CalibrationMasters(bias,dark_current,flat,gain,plane_gains)
+
+def calibrate_frame(raw_image,exposure,masters,out=None,raw_colors=None,color_desc=None):
+    """
+    Returns the calibrated float32 frame: raw_image minus the master bias
+    and exposure seconds of dark current, divided by the normalized flat
+    and by the gain, so in e- if masters has a gain. Per-plane gains need
+    raw_colors (the top-left 2x2 of rawpy's raw_colors) and color_desc.
+    out is an optional float32 buffer to reuse.
+    """
+    arrays = masters.arrays()
+    if out is None:
+        out = np.empty(raw_image.shape,dtype="float32")
+    np.copyto(out,raw_image,casting="unsafe")
+    if "bias" in arrays:
+        out -= arrays["bias"]
+    if "dark_current" in arrays:
+        out -= np.float32(exposure)*arrays["dark_current"]
+    if "flat" in arrays:
+        out /= arrays["flat"]
+    if masters.plane_gains is not None and raw_colors is not None:
+        names = plane_names(raw_colors,color_desc)
+        planes = cfa_planes(out)
+        for i in range(2):
+            for j in range(2):
+                planes[i,j] /= np.float32(masters.plane_gains[names[i][j]])
+    elif masters.gain:
+        out /= np.float32(masters.gain)
+    return out
+
+def _calibrate_batch(tasks,masters_by_iso,dtype,pedestal):
+    import rawpy
+    out = None
+    result = []
+    for fn, outfn, iso, exposure in tasks:
+        try:
+            with rawpy.imread(fn) as raw:
+                raw_image = raw.raw_image
+                if out is None or out.shape != raw_image.shape:
+                    out = np.empty(raw_image.shape,dtype="float32")
+                calibrate_frame(raw_image,exposure,masters_by_iso[iso],out,
+                                raw.raw_colors[:2,:2].tolist(),raw.color_desc.decode())
+        except Exception as e:
+            print(f"Error calibrating image: {fn}: {e}")
+            result.append(None)
+            continue
+        if np.dtype(dtype) == np.uint16:
+            # uint16 can't hold the negative noise around zero
+            out += pedestal
+            np.rint(out,out=out)
+            np.clip(out,0,2**16-1,out=out)
+        tmp_path = f"{outfn}.{os.getpid()}.tmp"
+        with open(tmp_path,"wb") as tmp_file:
+            np.save(tmp_file,out.astype(dtype,copy=False))
+        os.replace(tmp_path,outfn)
+        result.append(outfn)
+    return result
+
+def calibrate_frames(fns,masters_by_iso,out_dir,dtype="float32",pedestal=0.,index=None,n_workers=None,files_per_task=8):
+    """
+    Calibrates the light frames fns with the CalibrationMasters of their ISO
+    in masters_by_iso ({iso: masters}), writing out_dir/<name>.npy as
+    float32, or as uint16 rounded after adding pedestal. ISO and exposure
+    come from index, a FrameIndex (updated with fns first).
+
+    Frames are decoded and calibrated in batches of files_per_task in a pool
+    of n_workers processes, each reusing one output buffer. The masters'
+    signatures and the output options of each ISO are recorded in
+    out_dir/calibration.json once a run finishes. Outputs newer than their
+    raw file are kept if those are unchanged, so an interrupted run can just
+    be rerun, while rebuilt masters or new options redo the whole ISO.
+    Returns the output paths, None for frames that failed or have no
+    masters.
+    """
+    if index is None:
+        index = FrameIndex()
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    index.update(fns)
+    for masters in masters_by_iso.values():
+        masters.prepare()
+    os.makedirs(out_dir,exist_ok=True)
+    signature_fn = os.path.join(out_dir,"calibration.json")
+    signatures = {}
+    if os.path.exists(signature_fn):
+        with open(signature_fn) as infile:
+            signatures = json.load(infile)
+    new_signatures = {str(iso):{"masters":masters.signature(),"dtype":np.dtype(dtype).name,"pedestal":float(pedestal)}
+                      for iso, masters in masters_by_iso.items()}
+    outfns = {}
+    tasks = []
+    for fn in fns:
+        outfn = os.path.join(out_dir,os.path.splitext(os.path.basename(fn))[0]+".npy")
+        metadata = index.lookup(fn)
+        if metadata is None or not (metadata["iso"] in masters_by_iso):
+            print(f"No calibration masters for: {fn}")
+            outfns[fn] = None
+            continue
+        outfns[fn] = outfn
+        if (signatures.get(str(metadata["iso"])) == new_signatures[str(metadata["iso"])] and os.path.exists(outfn)
+                and os.path.getmtime(outfn) >= os.path.getmtime(fn)):
+            continue
+        tasks.append((fn,outfn,metadata["iso"],metadata["exposure"]))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(_calibrate_batch,tasks[i:i+files_per_task],masters_by_iso,dtype,pedestal)
+                   for i in range(0,len(tasks),files_per_task)]
+        for i, future in zip(range(0,len(tasks),files_per_task),futures):
+            for (fn, outfn, iso, exposure), result in zip(tasks[i:i+files_per_task],future.result()):
+                outfns[fn] = result
+    signatures.update(new_signatures)
+    tmp_path = f"{signature_fn}.{os.getpid()}.tmp"
+    with open(tmp_path,"w") as outfile:
+        json.dump(signatures,outfile,indent=1)
+    os.replace(tmp_path,signature_fn)
+    return [outfns[fn] for fn in fns]
+
+def calibrate(fns,isos,out_dir="calibrated",flat=None,gain_file="gain.pkl",bias_dir="BIAS",dtype="float32",pedestal=0.,n_workers=None):
+    """
+    Calibrates the light frames fns of the ISOs in isos with their
+    default_masters, see calibrate_frames. Returns the output paths.
+    """
+    masters_by_iso = {int(iso):default_masters(iso,flat,gain_file,bias_dir) for iso in isos}
+    outfns = calibrate_frames(fns,masters_by_iso,out_dir,dtype,pedestal,n_workers=n_workers)
+    print(f"Calibrated {sum(outfn is not None for outfn in outfns)} of {len(fns)} frames")
+    return outfns
+
+if __name__ == "__main__":
+
+    isos = [100,200,400,800,1600]
+    fns = sorted(glob.glob("LIGHT/*.cr2"))
+    calibrate(fns,isos)
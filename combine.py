@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import os
+import concurrent.futures
+import numpy as np
+from raw_cache import RawCache
+from tiled_stats import row_bands, _cache_frame
+
+def combine_median(stack):
+    return np.median(stack,axis=0,overwrite_input=True)
+
+def combine_sigma_clip(stack,sigma=3.,max_iters=5):
+    """
+    Mean of each pixel's frames after iteratively rejecting those more than
+    sigma standard deviations from the median of the frames kept so far.
+    """
+    stack = stack.astype("float32",copy=False)
+    n_rejected = 0
+    for i in range(max_iters):
+        center = np.nanmedian(stack,axis=0)
+        std = np.nanstd(stack,axis=0)
+        reject = np.abs(stack-center) > sigma*std
+        stack[reject] = np.nan
+        n = np.count_nonzero(np.isnan(stack))
+        if n == n_rejected:
+            break
+        n_rejected = n
+    return np.nanmean(stack,axis=0)
+
+def combine_minmax(stack,n_low=1,n_high=1):
+    """
+    Mean of each pixel's frames after rejecting the n_low lowest and n_high
+    highest.
+    """
+    if n_low+n_high >= len(stack):
+        raise Exception(f"Can't reject {n_low}+{n_high} of {len(stack)} frames")
+    stack.sort(axis=0)
+    return stack[n_low:len(stack)-n_high].mean(axis=0)
+
+COMBINERS = {"median":combine_median,"sigma_clip":combine_sigma_clip,"minmax":combine_minmax}
+
+def _combine_band(fns,cache,r0,r1,out_fn,method,kwargs):
+    frame = cache.get(fns[0])
+    stack = np.empty((len(fns),r1-r0)+frame.shape[1:],dtype="float32")
+    for i, fn in enumerate(fns):
+        stack[i] = cache.get(fn)[r0:r1]
+    out = np.load(out_fn,mmap_mode="r+")
+    out[r0:r1] = COMBINERS[method](stack,**kwargs)
+    out.flush()
+
+def combine_stack(fns,out_fn,method="median",cache=None,memory_bytes=2**30,n_workers=None,**kwargs):
+    """
+    Combines the stack of raw frames fns pixel by pixel with a robust
+    combiner from COMBINERS ("median", "sigma_clip" or "minmax"; kwargs are
+    passed on to it) and writes the float32 result to out_fn.
+
+    Like tiled_stats.tiled_stack_stats, every frame is decoded once into
+    cache, then the sensor is combined one band of rows at a time in a pool
+    of n_workers processes. Bands are as tall as fits in memory_bytes over
+    all workers, so memory use doesn't grow with the sensor size, only the
+    band height shrinks with the number of frames.
+
+    Returns the result, memory mapped read-only.
+    """
+    if not (method in COMBINERS):
+        raise Exception(f"{method} is not one of the combiners: {', '.join(COMBINERS)}")
+    if cache is None:
+        cache = RawCache()
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    fns = sorted(fns)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+        shapes = list(executor.map(_cache_frame,fns,[cache]*len(fns)))
+        fns = [fn for fn, shape in zip(fns,shapes) if shape is not None]
+        if len(fns) == 0:
+            raise Exception(f"None of the frames for {out_fn} could be read")
+        shape = [shape for shape in shapes if shape is not None][0]
+        # the float32 band stack, plus about twice that in temporaries
+        row_bytes = 3*len(fns)*shape[1]*np.dtype("float32").itemsize
+        band_rows = max(2,memory_bytes//(n_workers*row_bytes)//2*2)
+        os.makedirs(os.path.dirname(out_fn) or ".",exist_ok=True)
+        out = np.lib.format.open_memmap(out_fn,mode="w+",dtype="float32",shape=shape)
+        del out
+        futures = [executor.submit(_combine_band,fns,cache,r0,r1,out_fn,method,kwargs)
+                   for r0, r1 in row_bands(shape[0],band_rows)]
+        for future in futures:
+            future.result()
+    return np.load(out_fn,mmap_mode="r")
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+import os
+import concurrent.futures
+import numpy as np
+from tiled_stats import row_bands
+from toy_noise import linear_fit_batch
+
+# bits of the flags map
+HOT = 1     # dark current far above the sensor's
+NOISY = 2   # dark signal far from linear in exposure, e.g. telegraph noise
+BAD_FIT = 4 # no finite fit
+
+BAD_PIXEL_DTYPE = np.dtype([("row","int32"),("col","int32"),("flags","uint8"),("dark_current","float32")])
+
+def _fit_band(mean_fns,exposures,r0,r1,out_fns,gain):
+    frames = [np.load(fn,mmap_mode="r")[r0:r1] for fn in mean_fns]
+    n_cols = frames[0].shape[1]
+    # (pixels, exposures) so each row is one pixel's fit
+    y = np.stack([frame.reshape(-1) for frame in frames],axis=1)
+    if gain:
+        y = y/gain
+    slope, intercept, slope_err, intercept_err, yerr = linear_fit_batch(exposures,y)
+    for name, result in zip(["dark_current","offset","residual"],[slope,intercept,yerr]):
+        out = np.load(out_fns[name],mmap_mode="r+")
+        out[r0:r1] = result.reshape((r1-r0,n_cols))
+        out.flush()
+
+def _flag_band(out_fns,r0,r1,hot_threshold,noisy_threshold):
+    dark_current = np.load(out_fns["dark_current"],mmap_mode="r")[r0:r1]
+    residual = np.load(out_fns["residual"],mmap_mode="r")[r0:r1]
+    flags = np.zeros(dark_current.shape,dtype="uint8")
+    flags[dark_current > hot_threshold] |= HOT
+    flags[residual > noisy_threshold] |= NOISY
+    flags[~(np.isfinite(dark_current) & np.isfinite(residual))] |= BAD_FIT
+    out = np.load(out_fns["flags"],mmap_mode="r+")
+    out[r0:r1] = flags
+    out.flush()
+    rows, cols = np.nonzero(flags)
+    bad = np.empty(len(rows),dtype=BAD_PIXEL_DTYPE)
+    bad["row"] = rows+r0
+    bad["col"] = cols
+    bad["flags"] = flags[rows,cols]
+    bad["dark_current"] = dark_current[rows,cols]
+    return bad
+
+def _robust_threshold(fn,n_sigma):
+    """
+    Returns median + n_sigma robust standard deviations (from the median
+    absolute deviation) of the finite values of the map in fn.
+    """
+    values = np.load(fn,mmap_mode="r")
+    values = values[np.isfinite(values)]
+    median = np.median(values)
+    sigma = 1.4826*np.median(np.abs(values-median))
+    return median + n_sigma*sigma
+
+def dark_current_maps(mean_fns,exposures,out_prefix,gain=None,hot_sigma=5.,noisy_sigma=8.,band_rows=256,n_workers=None):
+    """
+    Fits dark signal against exposure time for every pixel at once.
+
+    mean_fns are .npy per-pixel mean dark frames, one per exposure (in
+    seconds), e.g. from calib_store.AccumulatorStore.mean_path, and are
+    only read a band of band_rows rows at a time, each band fitted in one
+    toy_noise.linear_fit_batch call in a pool of n_workers processes.
+    Signals are divided by gain (in ADU/e-) if given.
+
+    Writes float32 maps out_prefix+"_dark_current.npy" (per second),
+    "_offset.npy" (the zero-exposure level) and "_residual.npy" (the fit's
+    y error), a uint8 out_prefix+"_flags.npy" of HOT, NOISY and BAD_FIT
+    bits, set where the dark current or residual is more than hot_sigma or
+    noisy_sigma robust standard deviations above the median, and
+    out_prefix+"_bad_pixels.npy", the flagged pixels as a BAD_PIXEL_DTYPE
+    list. Returns the flags, memory mapped read-only, and the list.
+    """
+    if len(mean_fns) != len(exposures):
+        raise Exception("Need one mean frame per exposure")
+    if len(mean_fns) < 3:
+        raise Exception(f"Need at least 3 exposures to fit dark current, got {len(mean_fns)}")
+    exposures = np.array(exposures,dtype="float64")
+    shape = np.load(mean_fns[0],mmap_mode="r").shape
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    out_fns = {name:f"{out_prefix}_{name}.npy" for name in ["dark_current","offset","residual","flags"]}
+    os.makedirs(os.path.dirname(out_prefix) or ".",exist_ok=True)
+    for name in out_fns:
+        out = np.lib.format.open_memmap(out_fns[name],mode="w+",dtype="uint8" if name == "flags" else "float32",shape=shape)
+        del out
+    bands = row_bands(shape[0],band_rows)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(_fit_band,mean_fns,exposures,r0,r1,out_fns,gain) for r0, r1 in bands]
+        for future in futures:
+            future.result()
+        hot_threshold = _robust_threshold(out_fns["dark_current"],hot_sigma)
+        noisy_threshold = _robust_threshold(out_fns["residual"],noisy_sigma)
+        futures = [executor.submit(_flag_band,out_fns,r0,r1,hot_threshold,noisy_threshold) for r0, r1 in bands]
+        bad = np.concatenate([future.result() for future in futures])
+    np.save(out_prefix+"_bad_pixels.npy",bad)
+    return np.load(out_fns["flags"],mmap_mode="r"), bad
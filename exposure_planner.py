@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import numpy as np
+from toy_noise import linear_fit
+
+class ExposurePlanner:
+    """
+    Picks which exposures of a flat-field sweep are worth capturing.
+
+    The first n_probes exposures are captured as usual and their mean signal
+    passed to add_probe(). Since the signal of a flat grows linearly with
+    exposure time (the same model find_gain.py fits its photon-transfer
+    curve to), a straight-line fit to the probes predicts the signal of every
+    other exposure. plan() then returns about n_points exposures whose
+    predicted signals are spread evenly from the probes up to max_fraction
+    of saturation, skipping exposures that would saturate and ones too close
+    in signal to an exposure already chosen.
+    """
+
+    def __init__(self,exposures,n_probes=3,n_points=10,max_fraction=0.9,saturation=2**14-1):
+        self.exposures = np.array(exposures,dtype="float64")
+        self.n_probes = n_probes
+        self.n_points = n_points
+        self.max_fraction = max_fraction
+        self.saturation = saturation
+        self.probe_exposures = []
+        self.probe_means = []
+
+    def probes(self):
+        """
+        Returns the indices of the exposures to capture before planning.
+        """
+        return list(range(min(self.n_probes,len(self.exposures))))
+
+    def add_probe(self,exposure,mean,saturation=None):
+        self.probe_exposures.append(exposure)
+        self.probe_means.append(mean)
+        if saturation is not None:
+            self.saturation = saturation
+
+    def predict(self):
+        """
+        Returns the predicted mean signal at every exposure.
+        """
+        slope, intercept = linear_fit(self.probe_exposures,self.probe_means,printinfo=False)[:2]
+        return intercept + slope*self.exposures
+
+    def plan(self):
+        """
+        Returns the sorted indices of the exposures still to capture.
+        """
+        if len(self.probe_means) < 3:
+            # too few probes to fit, so fall back to the full sweep
+            return list(range(len(self.probes()),len(self.exposures)))
+        predicted = self.predict()
+        probed = set(self.probes())
+        max_signal = self.max_fraction*self.saturation
+        usable = np.flatnonzero(predicted < max_signal)
+        usable = [int(i) for i in usable if not (i in probed)]
+        if len(usable) == 0:
+            return []
+        low = max(self.probe_means)
+        spacing = (max_signal-low)/self.n_points
+        chosen = []
+        taken_signals = list(self.probe_means)
+        for target in np.linspace(low+spacing,max_signal,self.n_points):
+            i = min(usable,key=lambda j: abs(predicted[j]-target))
+            if min(abs(predicted[i]-x) for x in taken_signals) < spacing/2:
+                continue
+            chosen.append(i)
+            taken_signals.append(predicted[i])
+        return sorted(chosen)
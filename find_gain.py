@@ -1,65 +1,195 @@
 #!/usr/bin/env python3
 
-import rawpy
-import imageio
-import pyexiv2
+import os
 import glob
+import json
+import functools
 import pickle
 import numpy as np
-import matplotlib.pyplot as plt
-from investigate_bias import OnlineStatsCalc, get_stats, make_stats_and_frames
+from parallel_reduce import read_raw_frame
+from calib_store import AccumulatorStore, summarize_medians, roi_label
+from raw_cache import RawCache
 from toy_noise import linear_fit, plot_linear_fit
+from bayer import read_cfa_layout, plane_names, summarize_cfa_medians, ptc_fit_planes
+from pair_ptc import pair_ptc
+from frame_index import FrameIndex
 
-if __name__ == "__main__":
+def master_bias_keys(isos,bias_dir="BIAS"):
+    """
+    Returns {iso: key of the shortest-exposure master bias frame in
+    investigate_bias.py's calib/BIAS store} for the ISOs with bias frames
+    in bias_dir.
+    """
+    index = FrameIndex()
+    fns_by_iso_shutter_speed = index.fns_by_iso_shutter_speed(isos=[int(iso) for iso in isos],prefix=os.path.join(bias_dir,""))
+    result = {}
+    for iso in isos:
+        shutter_speeds = fns_by_iso_shutter_speed.get(int(iso),{})
+        if len(shutter_speeds) > 0:
+            result[iso] = (int(iso),min(shutter_speeds))
+    return result
+
+def master_bias_by_iso(isos,roi,bias_dir="BIAS"):
+    """
+    Returns {iso: ROI of the shortest-exposure master bias frame} for the
+    ISOs that investigate_bias.py has built one for from bias_dir.
+    """
+    store = AccumulatorStore("calib/BIAS")
+    result = {}
+    for iso, key in master_bias_keys(isos,bias_dir).items():
+        stats = store.load(key)
+        if stats is not None:
+            result[iso] = np.array(stats.get_mean()[roi])
+    return result
+
+def gain_inputs_signature(isos,roi,groups,store,pair_difference,subtract_bias,bias_dir):
+    """
+    Returns a JSON-serializable description of everything find_gain's
+    results depend on: the options, the flat groups' accumulators and, if
+    used, the master bias frames, each with its modification time.
+    """
+    def file_signature(fn):
+        return [fn,os.stat(fn).st_mtime_ns] if os.path.exists(fn) else None
+    signature = {"isos":list(isos),"roi":roi_label(roi),"pair_difference":pair_difference,
+                 "subtract_bias":subtract_bias,"groups":{},"bias":{}}
+    for key in sorted(groups):
+        signature["groups"][key] = [sorted(groups[key]),file_signature(store.mean_path(key))]
+    if pair_difference and subtract_bias:
+        bias_store = AccumulatorStore("calib/BIAS")
+        for iso, key in master_bias_keys(isos,bias_dir).items():
+            signature["bias"][iso] = file_signature(bias_store.mean_path(key))
+    return signature
+
+def find_gain(isos,roi,walldata="walldata",pair_difference=True,subtract_bias=True,bias_dir="BIAS",gain_file="gain.pkl",plot=True):
+    """
+    Fits the gain of the ISOs in isos, pooled and per CFA plane, from the
+    flats in walldata/ISO<iso>/<exposure>/*.cr2, over the (rows, columns)
+    slices roi, and saves them to gain_file. If plot, the variance against
+    mean is plotted to wall_varVmean.png.
 
-    fig, ax = plt.subplots()
-    isos = ["100","200","400","800","1600"]
+    pair_difference also fits var(A-B)/2 of the first two flats of each
+    exposure, which only needs take_data.take_flat_data(...,pairs=True), to
+    cross-check, with the master bias of bias_dir subtracted if
+    subtract_bias.
+    """
+    if plot:
+        import matplotlib.pyplot as plt
+        fig, ax = plt.subplots()
+    isos = [str(iso) for iso in isos]
     gains = []
     gain_errs = []
+    speed_dirs_by_iso = {iso:glob.glob(os.path.join(walldata,f"ISO{iso}","*")) for iso in isos}
+    groups = {}
+    for iso in isos:
+        for speed_dir in speed_dirs_by_iso[iso]:
+            groups[speed_dir] = glob.glob(speed_dir+"/*.cr2")
+    store = AccumulatorStore(f"calib/walldata_{roi_label(roi)}")
+    reader = functools.partial(read_raw_frame,roi=roi,cache=RawCache())
+    store.update(groups,reader=reader)
+    # the inputs gain_file was fitted from are recorded next to it
+    signature_fn = os.path.splitext(gain_file)[0]+"_inputs.json"
+    signature = gain_inputs_signature(isos,roi,groups,store,pair_difference,subtract_bias,bias_dir)
+    if os.path.exists(gain_file) and os.path.exists(signature_fn):
+        with open(signature_fn) as infile:
+            if json.load(infile) == signature:
+                print(f"No new frames or options, {gain_file} is up to date")
+                return
+    summarize_planes = functools.partial(summarize_cfa_medians,origin=(roi[0].start,roi[1].start))
+    names = None
+    for fns in groups.values():
+        if len(fns) > 0:
+            names = plane_names(*read_cfa_layout(fns[0]))
+            break
+    plane_gains = {}
+    pair_gains = {}
+    if pair_difference:
+        bias = {}
+        if subtract_bias:
+            bias_by_iso = master_bias_by_iso(isos,roi,bias_dir)
+            for iso in bias_by_iso:
+                bias.update({speed_dir:bias_by_iso[iso] for speed_dir in speed_dirs_by_iso[iso]})
+        pair_points = pair_ptc(groups,reader=reader,bias=bias,origin=(roi[0].start,roi[1].start))
     for iso in isos:
-        speed_dirs = glob.glob(f"walldata/ISO{iso}/*")
         means = []
         variances = []
-        for speed_dir in speed_dirs:
-            fns = glob.glob(speed_dir+"/*.cr2")
-            stats = None
-            for fn in fns:
-                img = None
-                with rawpy.imread(fn) as raw:
-                    try:
-                        img = np.array(raw.raw_image[1000:2024,1000:2024],dtype="float64")
-                    except Exception:
-                        print(f"Error reading image: {fn}")
-                        continue
-                if stats is None:
-                    stats = OnlineStatsCalc(img.shape)
-                stats.add_sample(img)
-            mean_img = stats.get_mean()
-            variance_img = stats.get_sample_variance()
-            means.append(np.median(mean_img))
-            variances.append(np.median(variance_img))
+        plane_means = []
+        plane_variances = []
+        for speed_dir in speed_dirs_by_iso[iso]:
+            if store.count(speed_dir) == 0:
+                continue
+            summary = store.summary(speed_dir,summarize_medians)
+            means.append(summary["mean"])
+            variances.append(summary["variance"])
+            summary = store.summary(speed_dir,summarize_planes,name="summarize_cfa_medians")
+            plane_means.append(summary["mean"])
+            plane_variances.append(summary["variance"])
         if len(means) > 0:
             means = np.array(means)
             variances = np.array(variances)
-            ax.scatter(means,variances,label="ISO"+iso)
             print("ISO"+iso)
             fit_results = linear_fit(means,variances)
             gains.append(fit_results[0])
             gain_errs.append(fit_results[2])
-            plot_linear_fit(ax,means,*fit_results)
+            if plot:
+                ax.scatter(means,variances,label="ISO"+iso)
+                plot_linear_fit(ax,means,*fit_results)
+            # each plane's variance against its own mean, all planes in one fit
+            plane_means = np.array(plane_means)
+            plane_variances = np.array(plane_variances)
+            slopes, _, slope_errs = ptc_fit_planes(plane_means,plane_variances)[:3]
+            plane_gains[iso] = {names[i][j]:{"gain":float(slopes[i,j]),"gain_err":float(slope_errs[i,j])}
+                                for i in range(2) for j in range(2)}
         else:
             gains.append(float('nan'))
             gain_errs.append(float('nan'))
-    ax.legend()
-    ax.set_xlabel("Pixel Mean [ADUs]")
-    ax.set_ylabel("Pixel Variance [(ADUs)$^2$]")
-    fig.savefig("wall_varVmean.png")
-    fig.savefig("wall_varVmean.pdf")
+        if pair_difference:
+            points = [pair_points[speed_dir] for speed_dir in speed_dirs_by_iso[iso]]
+            points = [point for point in points if point is not None]
+            if len(points) > 2:
+                pair_means = np.array([point["mean"] for point in points])
+                pair_variances = np.array([point["variance"] for point in points])
+                if plot:
+                    ax.scatter(pair_means,pair_variances,marker="x",label="ISO"+iso+" pairs")
+                print("ISO"+iso+" pair difference")
+                fit_results = linear_fit(pair_means,pair_variances)
+                pair_gains[iso] = {"gain":fit_results[0],"gain_err":fit_results[2]}
+                slopes, _, slope_errs = ptc_fit_planes(np.array([point["plane_mean"] for point in points]),
+                                                       np.array([point["plane_variance"] for point in points]))[:3]
+                pair_gains[iso]["planes"] = {names[i][j]:{"gain":float(slopes[i,j]),"gain_err":float(slope_errs[i,j])}
+                                             for i in range(2) for j in range(2)}
+    if plot:
+        ax.legend()
+        ax.set_xlabel("Pixel Mean [ADUs]")
+        ax.set_ylabel("Pixel Variance [(ADUs)$^2$]")
+        fig.savefig("wall_varVmean.png")
+        fig.savefig("wall_varVmean.pdf")
 
     gain_dict = {}
     print(f"{'ISO':4} Gain [e-/ADU]")
     for iso, gain, gain_err in zip(isos,gains,gain_errs):
         print(f"{iso:4} {gain:6.3f} +/- {gain_err:6.3f}")
         gain_dict[iso] = {"gain":gain,"gain_err":gain_err}
-    with open("gain.pkl","wb") as savefile:
+        if iso in plane_gains:
+            gain_dict[iso]["planes"] = plane_gains[iso]
+    print(f"{'ISO':4} {'CFA':3} Gain [e-/ADU]")
+    for iso in plane_gains:
+        for name, plane in plane_gains[iso].items():
+            print(f"{iso:4} {name:3} {plane['gain']:6.3f} +/- {plane['gain_err']:6.3f}")
+    if len(pair_gains) > 0:
+        print(f"{'ISO':4} {'Stack gain':16} {'Pair gain':16} [e-/ADU]")
+        for iso, gain, gain_err in zip(isos,gains,gain_errs):
+            if iso in pair_gains:
+                gain_dict[iso]["pairs"] = pair_gains[iso]
+                print(f"{iso:4} {gain:6.3f} +/- {gain_err:6.3f} {pair_gains[iso]['gain']:6.3f} +/- {pair_gains[iso]['gain_err']:6.3f}")
+    with open(gain_file,"wb") as savefile:
         pickle.dump(gain_dict,savefile)
+    tmp_path = f"{signature_fn}.{os.getpid()}.tmp"
+    with open(tmp_path,"w") as outfile:
+        json.dump(signature,outfile,indent=1)
+    os.replace(tmp_path,signature_fn)
+
+if __name__ == "__main__":
+
+    isos = [100,200,400,800,1600]
+    roi = (slice(1000,2024),slice(1000,2024))
+    find_gain(isos,roi)
@@ -1,79 +1,141 @@
 #!/usr/bin/env python3
 
-import rawpy
-import imageio
-import pyexiv2
-import sys
+import os
 import glob
+import functools
 import pickle
 import numpy as np
-import matplotlib.pyplot as plt
-from investigate_bias import OnlineStatsCalc, get_stats, make_stats_and_frames
+from investigate_bias import group_by_iso_shutter_speed
+from parallel_reduce import read_raw_frame
+from calib_store import AccumulatorStore, summarize_medians, roi_label
+from raw_cache import RawCache
+from frame_index import FrameIndex
 from toy_noise import linear_fit, plot_linear_fit
+from dark_maps import dark_current_maps
+from bayer import read_cfa_layout, plane_names, summarize_cfa_medians, ptc_fit_planes
 
-if __name__ == "__main__":
+def find_noise(isos,roi,darkdata="darkdata",dark_maps=False,gain_file="gain.pkl",plot=True):
+    """
+    Fits the read noise and dark current of the ISOs in isos, per CFA
+    plane, from the darks in darkdata/ISO<iso>/<exposure>/*.cr2, over the
+    (rows, columns) slices roi, in e- for the ISOs gain_file has a gain
+    for and in ADU for the others. If plot, the noise against exposure is
+    plotted to dark_varVmean.png.
 
-    fig, (ax1,ax2) = plt.subplots(figsize=(4,8),nrows=2)
-    isos = ["100","200","400","800","1600"]
-    gains = None
+    dark_maps also fits dark current for every pixel of the full frame,
+    writing calib/dark_maps/iso{iso}_*.npy maps, flags and bad pixel lists.
+    """
+    if plot:
+        import matplotlib.pyplot as plt
+        fig, (ax1,ax2) = plt.subplots(figsize=(4,8),nrows=2)
+    isos = [str(iso) for iso in isos]
+    gains = {}
     try:
-        with open("gain.pkl","rb") as gain_file:
-            gains = pickle.load(gain_file)
+        with open(gain_file,"rb") as infile:
+            gains = pickle.load(infile)
     except FileNotFoundError as e:
         print("Warning: Couldn't open gain file: ",e)
+    missing = [iso for iso in isos if not (iso in gains)]
+    if gains and len(missing) > 0:
+        print(f"Warning: {gain_file} has no gain for ISO {', '.join(missing)}, using ADU for them")
     maxstd = 0.
     maxvariance = 0.
+    cache = RawCache()
+    index = FrameIndex()
+    index.update(glob.glob(os.path.join(darkdata,"ISO*","*","*.cr2")),prefix=os.path.join(darkdata,""))
+    fns_by_iso_shutter_speed = index.fns_by_iso_shutter_speed(isos=[int(iso) for iso in isos],prefix=os.path.join(darkdata,""))
+    groups = group_by_iso_shutter_speed(fns_by_iso_shutter_speed)
+    store = AccumulatorStore(f"calib/darkdata_{roi_label(roi)}")
+    changed = store.update(groups,reader=functools.partial(read_raw_frame,roi=roi,cache=cache))
+    if dark_maps:
+        full_store = AccumulatorStore("calib/darkdata_full")
+        full_changed = full_store.update(groups,reader=functools.partial(read_raw_frame,cache=cache))
+        for iso in isos:
+            shutter_speeds = [shutter_speed for shutter_speed in sorted(fns_by_iso_shutter_speed.get(int(iso),{}))
+                              if full_store.count((int(iso),shutter_speed)) > 0]
+            out_prefix = f"calib/dark_maps/iso{iso}"
+            keys = [(int(iso),shutter_speed) for shutter_speed in shutter_speeds]
+            if len(keys) < 3 or (os.path.exists(out_prefix+"_bad_pixels.npy") and full_changed.isdisjoint(keys)):
+                continue
+            # maps stay in ADU, as calibrate.py subtracts them before the gain
+            flags, bad = dark_current_maps([full_store.mean_path(key) for key in keys],
+                                           [float(shutter_speed) for shutter_speed in shutter_speeds],
+                                           out_prefix)
+            median_dark_current = np.median(np.load(out_prefix+"_dark_current.npy",mmap_mode="r"))
+            if iso in gains:
+                print(f"ISO{iso} median dark current: {median_dark_current/gains[iso]['gain']:.4g} e-/s, {len(bad)} bad pixels")
+            else:
+                print(f"ISO{iso} median dark current: {median_dark_current:.4g} ADU/s, {len(bad)} bad pixels")
+    outputs_current = os.path.exists("dark_varVmean.png") and not (os.path.exists(gain_file)
+            and os.path.getmtime(gain_file) > os.path.getmtime("dark_varVmean.png"))
+    if len(changed) == 0 and plot and outputs_current:
+        print("No new frames, dark_varVmean.png is up to date")
+        return
+    if len(groups) == 0:
+        print(f"No dark frames for ISO {', '.join(isos)} in {darkdata}")
+        return
+    summarize_planes = functools.partial(summarize_cfa_medians,origin=(roi[0].start,roi[1].start))
+    names = plane_names(*read_cfa_layout(next(iter(groups.values()))[0]))
     for iso in isos:
         gain = None
-        if gains:
+        plane_gain = None
+        if iso in gains:
             gain = gains[iso]["gain"] # in ADUs / e-
-        speed_dirs = glob.glob(f"darkdata/ISO{iso}/*")
+            if "planes" in gains[iso]:
+                plane_gain = np.array([[gains[iso]["planes"][name]["gain"] for name in row] for row in names])
         speeds = []
         means = []
         variances = []
         stds = []
-        for speed_dir in speed_dirs:
-            fns = glob.glob(speed_dir+"/*.cr2")
-            stats = None
-            shutter_speed = None
-            for fn in fns:
-                if shutter_speed is None:
-                    md = pyexiv2.ImageMetadata(fn)
-                    md.read()
-                    shutter_speed = md.get_shutter_speed()
-                img = None
-                with rawpy.imread(fn) as raw:
-                    try:
-                        img = np.array(raw.raw_image[1000:2024,1000:2024],dtype="float64")
-                    except Exception:
-                        print(f"Error reading image: {fn}")
-                        continue
-                if gains:
-                    img /= gain # now image is in e-
-                if stats is None:
-                    stats = OnlineStatsCalc(img.shape)
-                stats.add_sample(img)
-            mean_img = stats.get_mean()
-            variance_img = stats.get_sample_variance()
-            std_img = stats.get_sample_std()
+        plane_variances = []
+        for shutter_speed in sorted(fns_by_iso_shutter_speed.get(int(iso),{})):
+            if store.count((int(iso),shutter_speed)) == 0:
+                continue
+            summary = store.summary((int(iso),shutter_speed),summarize_medians)
+            mean = summary["mean"]
+            variance = summary["variance"]
+            std = summary["std"]
+            plane_variance = np.array(store.summary((int(iso),shutter_speed),summarize_planes,
+                                                    name="summarize_cfa_medians")["variance"])
+            if gain is not None:
+                # now in e-
+                mean /= gain
+                variance /= gain**2
+                std /= gain
+                if plane_gain is None:
+                    plane_variance /= gain**2
+                else:
+                    plane_variance /= plane_gain**2
             speeds.append(shutter_speed)
-            means.append(np.median(mean_img))
-            variances.append(np.median(variance_img))
-            stds.append(np.median(std_img))
+            means.append(mean)
+            variances.append(variance)
+            stds.append(std)
+            plane_variances.append(plane_variance)
         if len(means) > 0:
             speeds = np.array(speeds,dtype="float32")
             means = np.array(means)
             variances = np.array(variances)
             stds = np.array(stds)
-            ax1.scatter(speeds,stds,label="ISO"+iso)
-            ax2.scatter(speeds,variances)
+            if plot:
+                ax1.scatter(speeds,stds,label="ISO"+iso if gain is not None or not gains else f"ISO{iso} [ADU]")
+                ax2.scatter(speeds,variances)
             if len(means) > 6:
                 print("ISO"+iso)
                 fit_results = linear_fit(speeds,variances)
-                plot_linear_fit(ax2,speeds,*fit_results)
+                if plot:
+                    plot_linear_fit(ax2,speeds,*fit_results)
+                # intercept is the read noise variance, slope the dark current
+                slopes, intercepts, slope_errs = ptc_fit_planes(speeds,np.array(plane_variances))[:3]
+                units = "e-" if gain is not None else "ADU"
+                print(f"{'CFA':3} Read noise [{units}] Dark current [{units}^2/s]")
+                for i in range(2):
+                    for j in range(2):
+                        print(f"{names[i][j]:3} {np.sqrt(max(intercepts[i,j],0.)):15.3f} {slopes[i,j]:10.4g} +/- {slope_errs[i,j]:.2g}")
             for std,variance in zip(stds,variances):
                 maxstd = max(std,maxstd)
                 maxvariance = max(variance,maxvariance)
+    if not plot:
+        return
     maxstd *= 1.1 
     maxvariance *= 1.1
     ax1.legend()
@@ -89,3 +151,9 @@ if __name__ == "__main__":
         ax2.set_ylabel("Pixel Variance [(ADUs)$^2$]")
     fig.savefig("dark_varVmean.png")
     fig.savefig("dark_varVmean.pdf")
+
+if __name__ == "__main__":
+
+    isos = [100,200,400,800,1600]
+    roi = (slice(1000,2024),slice(1000,2024))
+    find_noise(isos,roi)
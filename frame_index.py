@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+import os
+import hashlib
+import sqlite3
+from fractions import Fraction
+
+class FrameIndex:
+    """
+    SQLite sidecar with the metadata of a library of raw frames.
+
+    update() only reads EXIF from, and hashes, files that are new or whose
+    size or mtime changed since they were last indexed, so re-scanning a big
+    library is about as cheap as stat-ing it. Shutter speeds are stored as
+    exact fractions, like pyexiv2's get_shutter_speed() returns them.
+    """
+
+    def __init__(self,db_path="frame_index.sqlite"):
+        self.db_path = db_path
+        self.db = sqlite3.connect(db_path)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS frames (
+            path TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime_ns INTEGER,
+            iso INTEGER,
+            shutter_speed TEXT,
+            exposure REAL,
+            temperature REAL,
+            timestamp TEXT,
+            width INTEGER,
+            height INTEGER,
+            sha1 TEXT
+        )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS frames_iso_exposure ON frames (iso, exposure)")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def update(self,fns,prefix=None):
+        """
+        Indexes the files in fns that aren't already up to date. If fns are
+        all the frames whose path starts with prefix, e.g. a glob of a
+        directory, the rows of deleted files under prefix are removed.
+        Returns the number of files (re)indexed.
+        """
+        n_updated = 0
+        if prefix is not None:
+            fns = list(fns)
+            listed = set(fns)
+            for path in self._paths(prefix):
+                if not (path in listed) and not os.path.exists(path):
+                    self.db.execute("DELETE FROM frames WHERE path = ?",(path,))
+        for fn in fns:
+            st = os.stat(fn)
+            row = self.db.execute("SELECT size, mtime_ns FROM frames WHERE path = ?",(fn,)).fetchone()
+            if row == (st.st_size,st.st_mtime_ns):
+                continue
+            try:
+                values = read_frame_metadata(fn)
+            except Exception as e:
+                print(f"Error reading metadata: {fn}: {e}")
+                continue
+            self.db.execute("INSERT OR REPLACE INTO frames VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+                    (fn,st.st_size,st.st_mtime_ns,values["iso"],str(values["shutter_speed"]),
+                     float(values["shutter_speed"]),values["temperature"],values["timestamp"],
+                     values["width"],values["height"],values["sha1"]))
+            n_updated += 1
+        self.db.commit()
+        return n_updated
+
+    def lookup(self,fn):
+        """
+        Returns a dict of the indexed metadata for fn, or None if fn isn't
+        indexed.
+        """
+        cursor = self.db.execute("SELECT * FROM frames WHERE path = ?",(fn,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        result = dict(zip([x[0] for x in cursor.description],row))
+        result["shutter_speed"] = Fraction(result["shutter_speed"])
+        return result
+
+    def _paths(self,prefix):
+        sql = "SELECT path FROM frames WHERE substr(path,1,?) = ?"
+        return [row[0] for row in self.db.execute(sql,(len(prefix),prefix))]
+
+    def fns_by_iso_shutter_speed(self,isos=None,prefix=None):
+        """
+        Returns {iso: {shutter speed: [paths]}} for the frames whose path
+        starts with prefix, optionally only for the ISOs in isos.
+        """
+        result = {}
+        sql = "SELECT iso, shutter_speed, path FROM frames"
+        args = []
+        if prefix is not None:
+            sql += " WHERE substr(path,1,?) = ?"
+            args += [len(prefix),prefix]
+        sql += " ORDER BY path"
+        for iso, shutter_speed, path in self.db.execute(sql,args):
+            if isos is not None and not (iso in isos):
+                continue
+            shutter_speed = Fraction(shutter_speed)
+            result.setdefault(iso,{}).setdefault(shutter_speed,[]).append(path)
+        return result
+
+def read_frame_metadata(fn):
+    import pyexiv2
+    md = pyexiv2.ImageMetadata(fn)
+    md.read()
+    result = {
+        "iso": md.get_iso(),
+        "shutter_speed": Fraction(md.get_shutter_speed()),
+        "temperature": None,
+        "timestamp": None,
+        "width": None,
+        "height": None,
+    }
+    try:
+        result["temperature"] = float(md["Exif.CanonSi.CameraTemperature"].value)
+    except (KeyError, TypeError, ValueError):
+        pass
+    try:
+        result["timestamp"] = md["Exif.Photo.DateTimeOriginal"].value.isoformat()
+    except (KeyError, AttributeError):
+        pass
+    try:
+        result["width"], result["height"] = md.dimensions
+    except Exception:
+        pass
+    sha1 = hashlib.sha1()
+    with open(fn,"rb") as infile:
+        for block in iter(lambda: infile.read(2**20),b""):
+            sha1.update(block)
+    result["sha1"] = sha1.hexdigest()
+    return result
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+# percentiles reported by investigate_bias.get_stats
+PERCENTILES = [0.1,1,25,50,75,99,99.9]
+
+class TDigest:
+    """
+    Mergeable quantile sketch for float data, in the spirit of Dunning's
+    t-digest:
+
+        https://arxiv.org/abs/1902.04023
+
+    Values are kept as weighted centroids that are small near the tails and
+    large near the median. Each add() merges a whole batch of values in one
+    sort, so it stays vectorized for full frames.
+    """
+
+    def __init__(self,compression=200):
+        self.compression = compression
+        self.means = np.zeros(0)
+        self.weights = np.zeros(0)
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self,values):
+        values = np.asarray(values,dtype="float64").ravel()
+        if values.size == 0:
+            return
+        self.min = min(self.min,values.min())
+        self.max = max(self.max,values.max())
+        self._compress(np.concatenate([self.means,values]),
+                np.concatenate([self.weights,np.ones(values.size)]))
+
+    def merge(self,other):
+        if other.weights.size == 0:
+            return
+        self.min = min(self.min,other.min)
+        self.max = max(self.max,other.max)
+        self._compress(np.concatenate([self.means,other.means]),
+                np.concatenate([self.weights,other.weights]))
+
+    def _compress(self,means,weights):
+        order = np.argsort(means,kind="stable")
+        means = means[order]
+        weights = weights[order]
+        total = weights.sum()
+        q = (np.cumsum(weights)-weights/2)/total
+        # arcsine scale function: every centroid spans at most one unit of k
+        k = self.compression/(2*np.pi)*np.arcsin(2*q-1)
+        bucket = np.floor(k-k[0]).astype("intp")
+        new_weights = np.bincount(bucket,weights=weights)
+        new_sums = np.bincount(bucket,weights=weights*means)
+        keep = new_weights > 0
+        self.weights = new_weights[keep]
+        self.means = new_sums[keep]/self.weights
+
+    def quantile(self,q):
+        """
+        Returns the estimated quantile(s) q, with 0 <= q <= 1.
+        """
+        total = self.weights.sum()
+        centers = (np.cumsum(self.weights)-self.weights/2)/total
+        xp = np.concatenate([[0.],centers,[1.]])
+        fp = np.concatenate([[self.min],self.means,[self.max]])
+        return np.interp(q,xp,fp)
+
+class FrameStats:
+    """
+    Summary statistics and quantiles of one or more frames, computed in a
+    single pass per frame and updated incrementally with add().
+
+    Unsigned integer frames (raw ADUs) go into an exact histogram, so their
+    moments and percentiles are exact and match np.percentile with
+    method="midpoint". Float frames go into a TDigest, so their percentiles
+    are approximate; use frame_summary() for exact results on one float frame.
+    """
+
+    def __init__(self,compression=200):
+        self.counts = None
+        self.digest = None
+        self.compression = compression
+        self.n = 0
+        self.mean = 0.
+        self.m2 = 0.
+
+    def add(self,image):
+        image = np.asarray(image)
+        if image.dtype.kind in "bu":
+            if self.digest is not None:
+                raise Exception("Can't add integer frames to FrameStats holding float frames")
+            counts = np.bincount(image.ravel(),minlength=2**14)
+            if self.counts is None:
+                self.counts = counts
+            elif len(counts) > len(self.counts):
+                counts[:len(self.counts)] += self.counts
+                self.counts = counts
+            else:
+                self.counts[:len(counts)] += counts
+            return
+        if self.counts is not None:
+            raise Exception("Can't add float frames to FrameStats holding integer frames")
+        if self.digest is None:
+            self.digest = TDigest(self.compression)
+        self.digest.add(image)
+        # merge the frame's moments into the totals (Chan et al.)
+        n_b = image.size
+        mean_b = image.mean(dtype="float64")
+        m2_b = np.square(image-mean_b,dtype="float64").sum()
+        n = self.n + n_b
+        delta = mean_b - self.mean
+        self.mean += delta*n_b/n
+        self.m2 += m2_b + delta**2*self.n*n_b/n
+        self.n = n
+
+    def _values(self):
+        return np.arange(len(self.counts),dtype="float64")
+
+    def get_n(self):
+        if self.counts is not None:
+            return int(self.counts.sum())
+        return self.n
+
+    def get_mean(self):
+        if self.counts is not None:
+            return np.dot(self._values(),self.counts)/self.get_n()
+        return self.mean
+
+    def get_std(self):
+        if self.counts is not None:
+            deviations = self._values()-self.get_mean()
+            return np.sqrt(np.dot(deviations**2,self.counts)/self.get_n())
+        return np.sqrt(self.m2/self.n)
+
+    def get_min(self):
+        if self.counts is not None:
+            return float(np.flatnonzero(self.counts)[0])
+        return self.digest.min
+
+    def get_max(self):
+        if self.counts is not None:
+            return float(np.flatnonzero(self.counts)[-1])
+        return self.digest.max
+
+    def get_percentiles(self,percentiles):
+        percentiles = np.asarray(percentiles,dtype="float64")
+        if self.counts is None:
+            return self.digest.quantile(percentiles/100.)
+        cumulative = np.cumsum(self.counts)
+        position = percentiles/100.*(cumulative[-1]-1)
+        low = np.searchsorted(cumulative,np.floor(position),side="right")
+        high = np.searchsorted(cumulative,np.ceil(position),side="right")
+        return (low+high)/2.
+
+    def summary(self,percentiles=PERCENTILES):
+        """
+        Returns [mean, std, min, *percentiles, max].
+        """
+        return [self.get_mean(),self.get_std(),self.get_min(),*self.get_percentiles(percentiles),self.get_max()]
+
+def frame_summary(image,percentiles=PERCENTILES):
+    """
+    Returns [mean, std, min, *percentiles, max] of one frame, with the
+    percentiles computed like np.percentile(...,method="midpoint"). Integer
+    frames take one histogram pass, float frames one partition for all of
+    the percentiles plus the mean and std.
+    """
+    image = np.asarray(image)
+    if image.dtype.kind in "bu":
+        stats = FrameStats()
+        stats.add(image)
+        return stats.summary(percentiles)
+    values = np.percentile(image,[0,*percentiles,100],method="midpoint")
+    mean = image.mean(dtype="float64")
+    std = np.sqrt(np.square(image-mean,dtype="float64").mean())
+    return [mean,std,*values]
+
+def get_stats(image,table=False,table_header=False):
+    result = ""
+    if table_header:
+         result += f"{'mean':8} {'stddev':8} {'min':8} {'0.1%':8} {'1%':8} {'25%':8} {'50%':8} {'75%':8} {'99%':8} {'99.9%':8} {'max':8}"
+         return result
+    if isinstance(image,FrameStats):
+        values = image.summary(PERCENTILES)
+    else:
+        values = frame_summary(image,PERCENTILES)
+    if table:
+         result += " ".join(f"{x:8.3f}" for x in values)
+    else:
+        labels = ["mean:  ","std:   ","min:   ","0.1%:  "," 1%:   ","25%:   ","50%:   ","75%:   ","99%:   ","99.9%: ","max:   "]
+        result += "".join(f"{label}{x:.3f}" for label, x in zip(labels,values))
+    return result
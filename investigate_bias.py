@@ -1,53 +1,67 @@
 #!/usr/bin/env python3
 
-import rawpy
-import imageio
-import pyexiv2
+import os
 import glob
+import collections
+import functools
 import numpy as np
-import matplotlib.pyplot as plt
+import concurrent.futures
+from parallel_reduce import read_raw_frame
+from calib_store import AccumulatorStore, summarize_medians
+from raw_cache import RawCache
+from frame_index import FrameIndex
+from frame_stats import get_stats
+from tiled_stats import tiled_stack_stats
+from combine import combine_stack
+from stack_stats import median_variance_bias
 
-def make_stats_and_frames(image,fname_base):
+def make_stats_and_frames(image,fname_base,gamma=0.5):
         print(get_stats(image))
-        scaled = np.array(image,dtype="float64")
+        render_frames(image,fname_base,gamma)
+
+def render_frames(image,fname_base,gamma=0.5):
+        """
+        Saves histograms of the image, scaled to its 0.1%-99.9% range and
+        then gamma corrected, to fname_base+"_hist.png" and the 8-bit result
+        to fname_base+".tiff".
+
+        Everything after the initial copy into a float32 buffer is done in
+        place, each histogram is one blocked np.histogram pass over that
+        buffer and the histograms are drawn as precomputed step plots.
+        """
+        import imageio
+        from matplotlib.figure import Figure
+        scaled = np.array(image,dtype="float32")
         scaled /= 4096.
-        fig, ax = plt.subplots()
-        ax.hist(scaled.flatten(),bins=512, histtype="stepfilled",label="Original")
-        scaled -= np.quantile(scaled,0.001)
-        scaled /= np.quantile(scaled,0.999)
-        scaled = np.minimum(scaled,1.)
-        scaled = np.maximum(scaled,0.)
-        ax.hist(scaled.flatten(),bins=np.linspace(0,1,512), histtype="stepfilled",label="Scaling")
-        scaled = scaled**(gamma)
-        ax.hist(scaled.flatten(),bins=np.linspace(0,1,512), histtype="stepfilled",label="Gamma")
+        fig = Figure()
+        ax = fig.subplots()
+        counts, edges = np.histogram(scaled,bins=512)
+        ax.stairs(counts,edges,fill=True,label="Original")
+        low, high = np.quantile(scaled,[0.001,0.999])
+        scaled -= low
+        scaled /= high-low
+        np.clip(scaled,0.,1.,out=scaled)
+        counts, edges = np.histogram(scaled,bins=511,range=(0.,1.))
+        ax.stairs(counts,edges,fill=True,label="Scaling")
+        np.power(scaled,gamma,out=scaled)
+        counts, edges = np.histogram(scaled,bins=511,range=(0.,1.))
+        ax.stairs(counts,edges,fill=True,label="Gamma")
         ax.legend()
         ax.set_xlim(0,1)
         fig.savefig(fname_base+"_hist.png")
         # now return to 8 bit
         scaled *= 255
-        scaled = np.floor(scaled)
-        outimg = np.array(scaled,dtype="uint8")
+        np.floor(scaled,out=scaled)
+        outimg = scaled.astype("uint8")
         imageio.imsave(fname_base+".tiff",outimg)
 
-def get_stats(image,table=False,table_header=False):
-    result = ""
-    if table_header:
-         result += f"{'mean':8} {'stddev':8} {'min':8} {'0.1%':8} {'1%':8} {'25%':8} {'50%':8} {'75%':8} {'99%':8} {'99.9%':8} {'max':8}"
-    elif table:
-         result += f"{np.mean(image):8.3f} {np.std(image):8.3f} {np.min(image):8.3f} {np.percentile(image,0.1,interpolation='midpoint'):8.3f} {np.percentile(image,1,interpolation='midpoint'):8.3f} {np.percentile(image,25,interpolation='midpoint'):8.3f} {np.percentile(image,50,interpolation='midpoint'):8.3f} {np.percentile(image,75,interpolation='midpoint'):8.3f} {np.percentile(image,99,interpolation='midpoint'):8.3f} {np.percentile(image,99.9,interpolation='midpoint'):8.3f} {np.max(image):8.3f}"
-    else:
-        result += f"mean:  {np.mean(image):.3f}"
-        result += f"std:   {np.std(image):.3f}"
-        result += f"min:   {np.min(image):.3f}"
-        result += f"0.1%:  {np.percentile(image,0.1,interpolation='midpoint'):.3f}"
-        result += f" 1%:   {np.percentile(image,1,interpolation='midpoint'):.3f}"
-        result += f"25%:   {np.percentile(image,25,interpolation='midpoint'):.3f}"
-        result += f"50%:   {np.percentile(image,50,interpolation='midpoint'):.3f}"
-        result += f"75%:   {np.percentile(image,75,interpolation='midpoint'):.3f}"
-        result += f"99%:   {np.percentile(image,99,interpolation='midpoint'):.3f}"
-        result += f"99.9%: {np.percentile(image,99.9,interpolation='midpoint'):.3f}"
-        result += f"max:   {np.max(image):.3f}"
-    return result
+def stats_and_frames_job(image,fname_base,gamma=0.5):
+    """
+    Like make_stats_and_frames, but returns the stats instead of printing
+    them, for rendering several frames in a process pool.
+    """
+    render_frames(image,fname_base,gamma)
+    return get_stats(image)
 
 class OnlineStatsCalc:
     def __init__(self,shape):
@@ -71,72 +85,104 @@ class OnlineStatsCalc:
     def get_sample_variance(self):
         return self.ss/(self.n-1)
 
-if __name__ == "__main__":
+def group_by_iso_shutter_speed(fns_by_iso_shutter_speed):
+    groups = {}
+    for iso in fns_by_iso_shutter_speed:
+        for shutter_speed in fns_by_iso_shutter_speed[iso]:
+            groups[(iso,shutter_speed)] = fns_by_iso_shutter_speed[iso][shutter_speed]
+    return groups
 
-    bias_fnames = glob.glob("BIAS/*.cr2")
-    
-    gamma = 0.5
-    fns_by_iso_shutter_speed = {}
-    #for i in [100,200,400,800,1600]:
-    for i in [800,1600]:
-        fns_by_iso_shutter_speed[i] = {}
+def master_frames(key,fn_list,store,tiled_prefix=None,cache=None,combine=None,combined_fn=None):
+    """
+    Returns the mean and standard deviation frames of a group of frames,
+    and the number of frames they were built from, from the AccumulatorStore
+    or, if tiled_prefix is given, built band by band into memory-mapped
+    files starting with tiled_prefix. If combine names a combine.COMBINERS
+    method, the mean frame is replaced by that robust combination of the
+    frames, written to combined_fn.
+    """
+    if tiled_prefix is not None:
+        mean_img, std_img, n = tiled_stack_stats(fn_list,tiled_prefix,cache=cache)
+    else:
+        stats = store.load(key)
+        mean_img, std_img, n = stats.get_mean(), stats.get_sample_std(), stats.n
+    if combine is not None:
+        mean_img = combine_stack(fn_list,combined_fn,method=combine,cache=cache)
+    return mean_img, std_img, n
+
+def make_master_frames(isos,bias_dir="BIAS",dark_dir="DARK",tiled=False,combine=None,gamma=0.5,plot=True):
+    """
+    Builds, prints the stats of and, if plot, renders the bias and dark
+    master frames of the ISOs in isos from the raw files in bias_dir and
+    dark_dir, then plots the dark frames' noise against exposure.
+
+    tiled builds master frames band by band instead of in memory, for
+    sensors too big for this machine (always recomputing every group).
+    combine is None for plain mean master frames, or "median", "sigma_clip"
+    or "minmax" (see combine.py) to reject outliers like cosmic rays.
+    """
+    cache = RawCache()
+    reader = functools.partial(read_raw_frame,cache=cache)
+    index = FrameIndex()
+    # master frames are rendered to PNG/TIFF in parallel, with at most one
+    # per worker in flight, as each job holds a full frame in the call queue
+    n_workers = os.cpu_count()
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=n_workers)
+    renders = collections.deque()
+
+    def print_oldest():
+        label, future = renders.popleft()
+        print(label)
+        print(future.result())
+
+    def submit_stats(label,image,fname_base):
+        while len(renders) >= n_workers:
+            print_oldest()
+        if plot:
+            renders.append((label,executor.submit(stats_and_frames_job,image,fname_base,gamma)))
+        else:
+            renders.append((label,executor.submit(get_stats,image)))
+
+    index.update(glob.glob(os.path.join(bias_dir,"*.cr2")),prefix=os.path.join(bias_dir,""))
     
-    for fname in bias_fnames:
-        md = pyexiv2.ImageMetadata(fname)
-        md.read()
-        shutter_speed = md.get_shutter_speed()
-        iso = md.get_iso()
-        try:
-            fns_by_iso_shutter_speed[iso][shutter_speed].append(fname)
-        except KeyError:
-            fns_by_iso_shutter_speed[iso][shutter_speed] = [fname]
+    fns_by_iso_shutter_speed = index.fns_by_iso_shutter_speed(isos=isos,prefix=os.path.join(bias_dir,""))
     
     print("Bias Frames:")
+    store = AccumulatorStore("calib/BIAS")
+    if tiled:
+        changed = set(group_by_iso_shutter_speed(fns_by_iso_shutter_speed))
+    else:
+        changed = store.update(group_by_iso_shutter_speed(fns_by_iso_shutter_speed),reader=reader)
     for iso in sorted(fns_by_iso_shutter_speed):
         for shutter_speed in sorted(fns_by_iso_shutter_speed[iso]):
             fn_list = fns_by_iso_shutter_speed[iso][shutter_speed]
             #fn_list = fn_list[:10]
             nFiles = len(fn_list)
             print(f"ISO: {iso}, Shutter Speed: {shutter_speed}, N frames: {nFiles}")
-            stats = None
-            for fn in fn_list:
-                img = None
-                with rawpy.imread(fn) as raw:
-                    try:
-                        img = np.array(raw.raw_image,dtype="float64")
-                    except Exception:
-                        print(f"Error reading image: {fn}")
-                        continue
-                #img = img[1000:2024,1000:2024]
-                if stats is None:
-                    stats = OnlineStatsCalc(img.shape)
-                stats.add_sample(img)
-            mean_img = stats.get_mean()
-            std_img = stats.get_sample_std()
-            print("Mean Frame:")
-            make_stats_and_frames(mean_img,f"bias_mean_iso{iso}")
-            print("Stddev Frame:")
-            make_stats_and_frames(std_img,f"bias_std_iso{iso}")
-    
-    dark_fnames = glob.glob("DARK/*.cr2")
+            if not tiled and store.count((iso,shutter_speed)) == 0:
+                print("No readable frames")
+                continue
+            if not ((iso,shutter_speed) in changed):
+                print("No new frames, keeping existing master frames")
+                continue
+            tiled_prefix = f"calib/tiled/bias_iso{iso}" if tiled else None
+            combined_fn = f"calib/combined/bias_iso{iso}_{combine}.npy"
+            mean_img, std_img, n = master_frames((iso,shutter_speed),fn_list,store,tiled_prefix,cache,combine,combined_fn)
+            submit_stats(f"ISO: {iso} Mean Frame:",mean_img,f"bias_mean_iso{iso}")
+            submit_stats(f"ISO: {iso} Stddev Frame:",std_img,f"bias_std_iso{iso}")
+    while len(renders) > 0:
+        print_oldest()
     
-    gamma = 0.5
-    fns_by_iso_shutter_speed = {}
-    #for i in [100,200,400,800,1600]:
-    for i in [800,1600]:
-        fns_by_iso_shutter_speed[i] = {}
+    index.update(glob.glob(os.path.join(dark_dir,"*.cr2")),prefix=os.path.join(dark_dir,""))
     
-    for fname in dark_fnames:
-        md = pyexiv2.ImageMetadata(fname)
-        md.read()
-        shutter_speed = md.get_shutter_speed()
-        iso = md.get_iso()
-        try:
-            fns_by_iso_shutter_speed[iso][shutter_speed].append(fname)
-        except KeyError:
-            fns_by_iso_shutter_speed[iso][shutter_speed] = [fname]
+    fns_by_iso_shutter_speed = index.fns_by_iso_shutter_speed(isos=isos,prefix=os.path.join(dark_dir,""))
     
     print("Dark Frames:")
+    store = AccumulatorStore("calib/DARK")
+    if tiled:
+        changed = set(group_by_iso_shutter_speed(fns_by_iso_shutter_speed))
+    else:
+        changed = store.update(group_by_iso_shutter_speed(fns_by_iso_shutter_speed),reader=reader)
     shutter_speeds_by_iso = {}
     stds_by_iso = {}
     for iso in sorted(fns_by_iso_shutter_speed):
@@ -147,38 +193,46 @@ if __name__ == "__main__":
             #fn_list = fn_list[:10]
             nFiles = len(fn_list)
             print(f"ISO: {iso}, Shutter Speed: {shutter_speed}, N frames: {nFiles}")
-            mean_img = None
-            for fn in fn_list:
-                img = None
-                with rawpy.imread(fn) as raw:
-                    try:
-                        img = np.array(raw.raw_image,dtype="float64")
-                    except Exception:
-                        print(f"Error reading image: {fn}")
-                        continue
-                #img = img[1000:2024,1000:2024]
-                if stats is None:
-                    stats = OnlineStatsCalc(img.shape)
-                stats.add_sample(img)
-            mean_img = stats.get_mean()
-            std_img = stats.get_sample_std()
-            print("Mean Frame:")
-            make_stats_and_frames(mean_img,f"dark_mean_iso{iso}_{shutter_speed}s")
-            print("Stddev Frame:")
-            make_stats_and_frames(std_img,f"dark_std_iso{iso}_{shutter_speed}s")
-            stds_by_iso[iso].append(np.median(std_img))
+            if not tiled and store.count((iso,shutter_speed)) == 0:
+                print("No readable frames")
+                continue
+            if (iso,shutter_speed) in changed:
+                tiled_prefix = f"calib/tiled/dark_iso{iso}_{float(shutter_speed):g}s" if tiled else None
+                combined_fn = f"calib/combined/dark_iso{iso}_{float(shutter_speed):g}s_{combine}.npy"
+                mean_img, std_img, n = master_frames((iso,shutter_speed),fn_list,store,tiled_prefix,cache,combine,combined_fn)
+                label = f"ISO: {iso}, Shutter Speed: {shutter_speed}"
+                submit_stats(f"{label} Mean Frame:",mean_img,f"dark_mean_iso{iso}_{shutter_speed}s")
+                submit_stats(f"{label} Stddev Frame:",std_img,f"dark_std_iso{iso}_{shutter_speed}s")
+            else:
+                print("No new frames, keeping existing master frames")
+            if tiled:
+                # corrected like summarize_medians, so both paths agree
+                stds_by_iso[iso].append(np.median(std_img)/np.sqrt(median_variance_bias(n)))
+            else:
+                stds_by_iso[iso].append(store.summary((iso,shutter_speed),summarize_medians)["std"])
             shutter_speeds_by_iso[iso].append(float(shutter_speed))
+    while len(renders) > 0:
+        print_oldest()
+    executor.shutdown()
     
-    fig, ax = plt.subplots()
     for iso in sorted(stds_by_iso):
-        shutter_speeds = np.array(shutter_speeds_by_iso[iso])
-        stds = np.array(stds_by_iso[iso])
         print(iso)
-        print(shutter_speeds)
-        print(stds)
-        ax.scatter(shutter_speeds,stds,label=f"ISO={iso}")
+        print(np.array(shutter_speeds_by_iso[iso]))
+        print(np.array(stds_by_iso[iso]))
+    if not plot:
+        return
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots()
+    for iso in sorted(stds_by_iso):
+        ax.scatter(shutter_speeds_by_iso[iso],stds_by_iso[iso],label=f"ISO={iso}")
     ax.legend()
     ax.set_xlabel("Shutter Speed [s]")
     ax.set_ylabel("Pixel Standard Deviation (ADUs)")
     fig.savefig("dark_stdsVspeed.png")
     fig.savefig("dark_stdsVspeed.pdf")
+
+if __name__ == "__main__":
+
+    #isos = [100,200,400,800,1600]
+    isos = [800,1600]
+    make_master_frames(isos)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import time
+import threading
+import traceback
+
+from take_data import Camera, take_dark_data
+
+def list_cameras():
+    """
+    Returns a list of (model, port) of all attached cameras.
+    """
+    import gphoto2 as gp
+    return [(model, port) for model, port in gp.Camera.autodetect()]
+
+def camera_label(model,port):
+    """
+    Returns a name for the camera usable as a directory name, e.g.
+    "Canon_EOS_600D_usb_001_005".
+    """
+    return re.sub(r"[^A-Za-z0-9]+","_",f"{model}_{port}").strip("_")
+
+class SweepProgress:
+    """
+    Thread-safe progress and ETA of sweeps running on several cameras.
+    """
+
+    def __init__(self,outfile=sys.stdout):
+        self.outfile = outfile
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.done = {}
+        self.totals = {}
+        self.failed = set()
+
+    def device(self,label):
+        with self.lock:
+            self.done[label] = 0
+            self.totals[label] = 0
+        return DeviceProgress(self,label)
+
+    def eta(self):
+        """
+        Returns the estimated seconds until the slowest camera is done, or
+        None if no camera has finished a frame yet.
+        """
+        elapsed = time.time() - self.start_time
+        result = None
+        for label in self.done:
+            if label in self.failed or self.done[label] == 0:
+                continue
+            rate = self.done[label]/elapsed
+            remaining = max(0,self.totals[label]-self.done[label])/rate
+            result = remaining if result is None else max(result,remaining)
+        return result
+
+    def report(self):
+        with self.lock:
+            parts = []
+            for label in sorted(self.done):
+                status = " FAILED" if label in self.failed else ""
+                parts.append(f"{label}: {self.done[label]}/{self.totals[label]}{status}")
+            eta = self.eta()
+        if eta is None:
+            parts.append("ETA: ?")
+        else:
+            parts.append(f"ETA: {time.strftime('%H:%M:%S',time.gmtime(eta))}")
+        return " | ".join(parts)
+
+    def _advance(self,label,n):
+        with self.lock:
+            self.done[label] += n
+        print(self.report(),file=self.outfile,flush=True)
+
+class DeviceProgress:
+    """
+    Progress of the sweep on one camera, passed to take_dark_data and
+    take_flat_data.
+    """
+
+    def __init__(self,board,label):
+        self.board = board
+        self.label = label
+
+    def set_total(self,total):
+        with self.board.lock:
+            self.board.totals[self.label] = total
+
+    def advance(self,n=1):
+        self.board._advance(self.label,n)
+
+    def fail(self):
+        with self.board.lock:
+            self.board.failed.add(self.label)
+
+def run_sweeps(sweep,N,cameras=None,outdir=".",**kwargs):
+    """
+    Runs sweep (take_dark_data or take_flat_data) with N frames per setting
+    on every camera in cameras, a list of (model, port) defaulting to all
+    attached cameras, one thread per camera. Each camera's frames go under
+    outdir/<camera label>. A failing camera is reported and doesn't stop the
+    others.
+
+    Returns a dict mapping camera labels to None for sweeps that finished and
+    to the exception for ones that failed.
+    """
+    if cameras is None:
+        cameras = list_cameras()
+    board = SweepProgress()
+    results = {}
+
+    def run(model,port,label):
+        progress = board.device(label)
+        try:
+            camera = Camera(port=port,model=model)
+            sweep(camera,N,root=os.path.join(outdir,label),progress=progress,**kwargs)
+            results[label] = None
+        except Exception as e:
+            progress.fail()
+            print(f"Error in sweep on {label}:",file=sys.stderr)
+            traceback.print_exc()
+            results[label] = e
+
+    threads = []
+    for model, port in cameras:
+        label = camera_label(model,port)
+        thread = threading.Thread(target=run,args=(model,port,label),name=label)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    print(board.report(),flush=True)
+    return results
+
+if __name__ == "__main__":
+
+    cameras = list_cameras()
+    for model, port in cameras:
+        print(f"Found {model} at {port}")
+
+    N = 10
+
+    #run_sweeps(take_flat_data,N,cameras)
+    run_sweeps(take_dark_data,N,cameras)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+import os
+import concurrent.futures
+import numpy as np
+from bayer import cfa_planes
+from parallel_reduce import read_raw_frame
+
+def pair_difference(a,b,bias=None,origin=(0,0)):
+    """
+    Photon transfer point from a pair of flats a and b taken at the same
+    exposure: the mean signal, less bias (a scalar or a frame like a) if
+    given, and var(a-b)/2, in which fixed-pattern noise cancels. Returns a
+    dict with "mean" and "variance" over all pixels, and "plane_mean" and
+    "plane_variance" as 2x2 lists, one per CFA plane (see bayer.cfa_planes).
+    """
+    if a.shape != b.shape:
+        raise Exception(f"Flat pair shapes differ: {a.shape} and {b.shape}")
+    # exact for uint16 frames, and half the memory of float64
+    signal = np.add(a,b,dtype="int32" if a.dtype.kind in "ui" else "float64")
+    diff = np.subtract(a,b,dtype=signal.dtype)
+    signal_planes = cfa_planes(signal,origin).reshape((2,2,-1))
+    diff_planes = cfa_planes(diff,origin).reshape((2,2,-1))
+    plane_mean = signal_planes.mean(axis=-1)/2
+    plane_variance = diff_planes.var(axis=-1,ddof=1)/2
+    mean = signal.mean()/2
+    if bias is not None:
+        if np.ndim(bias) == 0:
+            plane_mean -= bias
+        else:
+            plane_mean -= cfa_planes(bias,origin).reshape((2,2,-1)).mean(axis=-1)
+        mean -= np.mean(bias)
+    return {"mean":float(mean),
+            "variance":float(diff.var(ddof=1)/2),
+            "plane_mean":plane_mean.tolist(),
+            "plane_variance":plane_variance.tolist()}
+
+def _pair_point(fns,reader,bias,origin):
+    a = reader(fns[0])
+    b = reader(fns[1])
+    if a is None or b is None:
+        return None
+    return pair_difference(a,b,bias,origin)
+
+def pair_ptc(groups,reader=read_raw_frame,bias=None,origin=(0,0),n_workers=None):
+    """
+    Computes pair_difference for each group of groups ({key: [file names]})
+    from the first two of its files in sorted order, in a process pool.
+    bias is None, a scalar or frame for all groups, or a dict mapping keys
+    to one. Returns {key: point}, where point is None if the group has fewer
+    than two readable files.
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    keys = [key for key in groups if len(groups[key]) >= 2]
+    result = {key:None for key in groups}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {}
+        for key in keys:
+            key_bias = bias.get(key) if isinstance(bias,dict) else bias
+            futures[key] = executor.submit(_pair_point,sorted(groups[key])[:2],reader,key_bias,origin)
+        for key in keys:
+            result[key] = futures[key].result()
+    return result
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+import os
+import concurrent.futures
+import numpy as np
+from raw_cache import read_raw
+from stream_pipeline import accumulate_frames
+
+def read_raw_frame(fn,roi=None,gain=None,cache=None):
+    """
+    Returns the uint16 raw Bayer image in fn, cropped to roi (a tuple of
+    slices). If gain is given the image is divided by it, which promotes it
+    to float64. Decoded images are taken from and stored in cache, a
+    raw_cache.RawCache, if given. Returns None if the file can't be decoded.
+    """
+    try:
+        img = read_raw(fn,roi=roi,cache=cache)
+    except Exception:
+        print(f"Error reading image: {fn}")
+        return None
+    if gain:
+        img = img/gain
+    return img
+
+def reduce_files(fns,reader=read_raw_frame,chunk_frames=8,dtype="float64"):
+    """
+    Accumulates the frames in fns, in order, into a StackStatsCalc.
+    Returns it, or None if none of the files could be read, and the list of
+    files that were read.
+    """
+    read_fns = []
+    def frames():
+        for fn in fns:
+            img = reader(fn)
+            if img is not None:
+                read_fns.append(fn)
+                yield img
+    stats = accumulate_frames(frames(),chunk_frames=chunk_frames,dtype=dtype,n_frames=len(fns))
+    return stats, read_fns
+
+def physical_memory():
+    """
+    Returns the machine's physical memory in bytes.
+    """
+    return os.sysconf("SC_PAGE_SIZE")*os.sysconf("SC_PHYS_PAGES")
+
+def _task_bytes(tasks,reader,chunk_frames,files_per_task,dtype):
+    # a task's accumulator holds its chunk buffer plus mean, ss and two
+    # scratch frames in dtype, next to one decoded frame
+    for key, fns in tasks:
+        for fn in fns:
+            img = reader(fn)
+            if img is not None:
+                return (min(chunk_frames,files_per_task)+5)*img.size*np.dtype(dtype).itemsize
+    return 0
+
+def reduce_groups(groups,reader=read_raw_frame,n_workers=None,files_per_task=4,chunk_frames=8,dtype="float64",memory_bytes=None):
+    """
+    Reduces several groups of frames in a process pool.
+
+    groups is a dict mapping any key (e.g. (iso, shutter speed)) to a list of
+    file names. Returns a dict mapping the same keys to (StackStatsCalc, or
+    None if no frame in the group could be read, list of the files that were
+    read). reader must be picklable,
+    e.g. a module-level function or a functools.partial of one.
+
+    Each group is split, in sorted file name order, into tasks of
+    files_per_task files. Workers decode and reduce whole tasks and the
+    partial accumulators are merged in task order, so the result only depends
+    on files_per_task and chunk_frames, never on n_workers. Partials are
+    merged as soon as all earlier tasks are, so only the ones that finish
+    early are held in memory.
+
+    n_workers defaults to one per CPU, but is lowered so the workers'
+    accumulators, sized from the first readable frame, fit in memory_bytes
+    (by default half the physical memory). Big sensors get fewer workers
+    rather than smaller chunks.
+    """
+    tasks = []
+    for key in groups:
+        fns = sorted(groups[key])
+        for i in range(0,len(fns),files_per_task):
+            tasks.append((key,fns[i:i+files_per_task]))
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    n_workers = max(1,min(n_workers,len(tasks)))
+    if n_workers > 1:
+        if memory_bytes is None:
+            memory_bytes = physical_memory()//2
+        task_bytes = _task_bytes(tasks,reader,chunk_frames,files_per_task,dtype)
+        if task_bytes > 0:
+            n_workers = max(1,min(n_workers,memory_bytes//task_bytes))
+    result = {key:None for key in groups}
+    read_fns = {key:[] for key in groups}
+
+    def merge(key,reduced):
+        partial, fns = reduced
+        read_fns[key] += fns
+        if partial is None:
+            return
+        if result[key] is None:
+            result[key] = partial
+        else:
+            result[key].merge(partial)
+            result[key].release()
+
+    if n_workers == 1:
+        for key, fns in tasks:
+            merge(key,reduce_files(fns,reader,chunk_frames,dtype))
+        return {key:(result[key],read_fns[key]) for key in groups}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+        task_by_future = {executor.submit(reduce_files,fns,reader,chunk_frames,dtype):i
+                          for i, (key, fns) in enumerate(tasks)}
+        finished = {}
+        next_task = 0
+        for future in concurrent.futures.as_completed(task_by_future):
+            finished[task_by_future.pop(future)] = future.result()
+            while next_task in finished:
+                merge(tasks[next_task][0],finished.pop(next_task))
+                next_task += 1
+    return {key:(result[key],read_fns[key]) for key in groups}
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import os
+import glob
+import hashlib
+import numpy as np
+
+class RawCache:
+    """
+    On-disk cache of decoded raw Bayer images.
+
+    Each file's raw_image is stored once, as uint16, in a .npy file named
+    after a hash of the file's absolute path, size and mtime, so editing or
+    replacing a raw file makes its old entry unreachable. get() returns a
+    read-only memory map, so slicing it (e.g. to an ROI) doesn't copy.
+
+    When the cache grows beyond max_bytes, the least recently used entries
+    are deleted. Entries are written atomically, so several processes can
+    share one cache directory.
+    """
+
+    def __init__(self,cache_dir=".rawcache",max_bytes=20*2**30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir,exist_ok=True)
+
+    def entry_path(self,fn):
+        st = os.stat(fn)
+        key = f"{os.path.abspath(fn)}\0{st.st_size}\0{st.st_mtime_ns}"
+        return os.path.join(self.cache_dir,hashlib.sha1(key.encode()).hexdigest()+".npy")
+
+    def get(self,fn):
+        if fn.endswith(".npy"):
+            # already decoded, e.g. by simulate_sensor.py
+            return np.load(fn,mmap_mode="r")
+        path = self.entry_path(fn)
+        try:
+            result = np.load(path,mmap_mode="r")
+            os.utime(path)
+            return result
+        except FileNotFoundError:
+            pass
+        import rawpy
+        with rawpy.imread(fn) as raw:
+            img = raw.raw_image.copy()
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path,"wb") as tmp_file:
+            np.save(tmp_file,img)
+        os.replace(tmp_path,path)
+        self.evict(keep=path)
+        return np.load(path,mmap_mode="r")
+
+    def evict(self,keep=None):
+        entries = []
+        total = 0
+        for path in glob.glob(os.path.join(self.cache_dir,"*.npy")):
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime,path,st.st_size))
+            total += st.st_size
+        entries.sort()
+        for mtime, path, size in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+def read_raw(fn,roi=None,cache=None):
+    """
+    Returns the uint16 raw Bayer image in fn, cropped to roi (a tuple of
+    slices). With a RawCache this is a view into a memory map, otherwise the
+    file is decoded. fn may also be a .npy file of an already decoded image.
+    """
+    if fn.endswith(".npy"):
+        img = np.load(fn,mmap_mode="r")
+        if roi is not None:
+            img = img[roi]
+        return img
+    if cache is not None:
+        img = cache.get(fn)
+        if roi is not None:
+            img = img[roi]
+        return img
+    import rawpy
+    with rawpy.imread(fn) as raw:
+        if roi is None:
+            return raw.raw_image.copy()
+        return raw.raw_image[roi].copy()
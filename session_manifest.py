@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import hashlib
+import threading
+
+class SessionManifest:
+    """
+    JSON record of the frames an acquisition session has completed, so an
+    interrupted sweep can be resumed instead of redone.
+
+    Each frame is keyed by (iso, shutter speed, index) and stored with its
+    file name, size and SHA-1. The manifest is rewritten atomically after
+    every change, so it is never left half written by a crash.
+    """
+
+    def __init__(self,path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.frames = {}
+        self.saturated = set()
+        try:
+            with open(path) as infile:
+                contents = json.load(infile)
+            self.frames = contents["frames"]
+            self.saturated = set(contents["saturated"])
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _key(*args):
+        return "|".join(str(x) for x in args)
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or ".",exist_ok=True)
+        tmp_path = self.path+".tmp"
+        with open(tmp_path,"w") as outfile:
+            json.dump({"frames":self.frames,"saturated":sorted(self.saturated)},outfile,indent=1)
+        os.replace(tmp_path,self.path)
+
+    def record(self,iso,shutterspeed,index,fname,data=None):
+        """
+        Records that frame index at iso and shutterspeed was saved to fname.
+        data are the file's contents, if already in memory, to save reading
+        it back for the hash.
+        """
+        if data is None:
+            with open(fname,"rb") as infile:
+                data = infile.read()
+        entry = {"fname":fname,"size":len(data),"sha1":hashlib.sha1(data).hexdigest()}
+        with self.lock:
+            self.frames[self._key(iso,shutterspeed,index)] = entry
+            self._save()
+
+    def is_complete(self,iso,shutterspeed,index,verify=False):
+        """
+        Returns True if the frame was recorded and its file still has the
+        recorded size, and, if verify, the recorded SHA-1.
+        """
+        with self.lock:
+            entry = self.frames.get(self._key(iso,shutterspeed,index))
+        if entry is None:
+            return False
+        try:
+            if os.path.getsize(entry["fname"]) != entry["size"]:
+                return False
+        except FileNotFoundError:
+            return False
+        if verify:
+            with open(entry["fname"],"rb") as infile:
+                return hashlib.sha1(infile.read()).hexdigest() == entry["sha1"]
+        return True
+
+    def get_fname(self,iso,shutterspeed,index):
+        with self.lock:
+            return self.frames[self._key(iso,shutterspeed,index)]["fname"]
+
+    def mark_saturated(self,iso,shutterspeed):
+        with self.lock:
+            self.saturated.add(self._key(iso,shutterspeed))
+            self._save()
+
+    def is_saturated(self,iso,shutterspeed):
+        with self.lock:
+            return self._key(iso,shutterspeed) in self.saturated
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+import os
+import numpy as np
+from bayer import cfa_planes
+
+class SensorModel:
+    """
+    Synthetic Bayer sensor, the toy_noise.py Poisson plus read noise model
+    grown into full frames, for benchmarks and for checking the analysis
+    against known truth.
+
+    Units follow the rest of the project: gain is in ADU/e- (the slope of a
+    photon transfer curve), read_noise in e-, dark_current in e-/s and flux
+    in e-/s on a pixel of response 1. Each of the R, G1, G2 and B planes
+    (raw_colors [[0,1],[3,2]] with color_desc "RGBG") has its own
+    cfa_response, every pixel a small random PRNU and bias offset, and a
+    hot_fraction of pixels hot_dark_current instead of dark_current.
+    Frames are uint16 and clip at white_level.
+    """
+
+    raw_colors = [[0,1],[3,2]]
+    color_desc = "RGBG"
+
+    def __init__(self,shape=(1024,1536),gain=0.5,read_noise=3.,bias=2048.,bias_fpn=2.,dark_current=0.2,
+                 hot_fraction=1e-4,hot_dark_current=50.,white_level=2**14-1,cfa_response=((0.6,1.),(1.,0.8)),
+                 prnu=0.01,seed=0):
+        self.shape = shape
+        self.gain = gain
+        self.read_noise = read_noise
+        self.white_level = white_level
+        self.rng = np.random.default_rng(seed)
+        self.bias_map = (bias+bias_fpn*self.rng.standard_normal(shape)).astype("float32")
+        self.response = (1.+prnu*self.rng.standard_normal(shape)).astype("float32")
+        cfa_planes(self.response)[...] *= np.array(cfa_response,dtype="float32")[:,:,np.newaxis,np.newaxis]
+        self.dark_current_map = np.full(shape,dark_current,dtype="float32")
+        n_hot = int(round(hot_fraction*self.response.size))
+        hot = self.rng.choice(self.response.size,n_hot,replace=False)
+        self.hot_pixels = np.unravel_index(np.sort(hot),shape)
+        self.dark_current_map[self.hot_pixels] = hot_dark_current
+
+    def frame(self,exposure,flux=0.,gain=None):
+        """
+        Returns one uint16 raw frame of exposure seconds at flux, with gain
+        (e.g. at another ISO) instead of the sensor's if given.
+        """
+        electrons = self.rng.poisson(exposure*(flux*self.response+self.dark_current_map)).astype("float32")
+        electrons += self.read_noise*self.rng.standard_normal(self.shape,dtype="float32")
+        electrons *= self.gain if gain is None else gain
+        electrons += self.bias_map
+        np.rint(electrons,out=electrons)
+        np.clip(electrons,0,self.white_level,out=electrons)
+        return electrons.astype("uint16")
+
+    def frames(self,n,exposure,flux=0.):
+        """
+        Yields n independent frames, generated one at a time.
+        """
+        for i in range(n):
+            yield self.frame(exposure,flux)
+
+    def stack(self,n,exposure,flux=0.):
+        """
+        Returns n frames as one (n, rows, cols) uint16 array.
+        """
+        return np.stack(list(self.frames(n,exposure,flux)))
+
+    def write_frames(self,dirname,n,exposure,flux=0.,prefix="sim_"):
+        """
+        Writes n frames to dirname as .npy files, which every reader in this
+        project (raw_cache.read_raw, RawCache) accepts in place of a raw
+        file. Returns their file names.
+        """
+        os.makedirs(dirname,exist_ok=True)
+        fns = []
+        for i, frame in enumerate(self.frames(n,exposure,flux)):
+            fn = os.path.join(dirname,f"{prefix}{i+1:04d}.npy")
+            np.save(fn,frame)
+            fns.append(fn)
+        return fns
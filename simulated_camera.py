@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+import io
+import time
+import threading
+from fractions import Fraction
+import numpy as np
+from simulate_sensor import SensorModel
+
+SHUTTERSPEEDS = ["bulb","30","25","20","15","13","10","8","6","5","4","3.2","2.5","2","1.6","1.3","1",
+                 "0.8","0.6","0.5","0.4","0.3","1/4","1/5","1/6","1/8","1/10","1/13","1/15","1/20","1/25",
+                 "1/30","1/40","1/50","1/60","1/80","1/100","1/125","1/160","1/200","1/250","1/320","1/400",
+                 "1/500","1/640","1/800","1/1000","1/1250","1/1600","1/2000","1/2500","1/3200","1/4000"]
+ISOS = ["Auto","100","200","400","800","1600","3200","6400"]
+
+class SimulatedWidget:
+    def __init__(self,name,value,choices):
+        self.name = name
+        self.value = value
+        self.choices = choices
+
+    def get_value(self):
+        return self.value
+
+    def set_value(self,value):
+        self.value = value
+
+    def get_choices(self):
+        return iter(self.choices)
+
+class SimulatedConfig:
+    def __init__(self,widgets):
+        self.widgets = {name:SimulatedWidget(name,widget.value,widget.choices) for name, widget in widgets.items()}
+
+    def get_child_by_name(self,name):
+        return self.widgets[name]
+
+class SimulatedFilePath:
+    def __init__(self,folder,name):
+        self.folder = folder
+        self.name = name
+
+class SimulatedFile:
+    def __init__(self,data):
+        self.data = data
+
+    def get_data_and_size(self):
+        return self.data
+
+    def save(self,outfn):
+        with open(outfn,"wb") as outfile:
+            outfile.write(self.data)
+
+class SimulatedCamera:
+    """
+    Stand-in for gphoto2.Camera, implementing the calls take_data.Camera
+    makes, so the acquisition code can be run and profiled without a
+    camera: take_data.Camera(backend=SimulatedCamera()).
+
+    Captures are frames of sensor (a simulate_sensor.SensorModel) at flux
+    e-/s (0 for dark frames), with the gain scaled in proportion to the ISO
+    from sensor.gain at ISO 100. They are returned as .npy files, which
+    this project's readers accept in place of raw files. The camera waits
+    for the exposure time plus capture_overhead on capture, for the file
+    size over usb_bytes_per_s on download, and config_latency for every
+    config read or write, all multiplied by time_scale (0 to not wait).
+
+    The gphoto2 constants take_data.Camera uses are attributes, with
+    gphoto2's values, so gphoto2 doesn't need to be installed.
+    """
+
+    raw_extension = ".npy"
+    GP_EVENT_UNKNOWN = 0
+    GP_EVENT_TIMEOUT = 1
+    GP_EVENT_FILE_ADDED = 2
+    GP_EVENT_FOLDER_ADDED = 3
+    GP_EVENT_CAPTURE_COMPLETE = 4
+    GP_EVENT_FILE_CHANGED = 5
+    GP_CAPTURE_IMAGE = 0
+    GP_FILE_TYPE_NORMAL = 1
+
+    def __init__(self,sensor=None,flux=20000.,usb_bytes_per_s=20e6,config_latency=0.05,capture_overhead=0.1,time_scale=1.):
+        if sensor is None:
+            sensor = SensorModel((2048,3072))
+        self.sensor = sensor
+        self.flux = flux
+        self.usb_bytes_per_s = usb_bytes_per_s
+        self.config_latency = config_latency
+        self.capture_overhead = capture_overhead
+        self.time_scale = time_scale
+        self.lock = threading.Lock()
+        self.widgets = {"iso":SimulatedWidget("iso","100",ISOS),
+                        "shutterspeed":SimulatedWidget("shutterspeed","1/100",SHUTTERSPEEDS),
+                        "bulb":SimulatedWidget("bulb",0,[0,1]),
+                        "aperture":SimulatedWidget("aperture","implicit auto",["implicit auto"])}
+        self.files = {}
+        self.n_captured = 0
+
+    def _wait(self,seconds):
+        if self.time_scale > 0:
+            time.sleep(seconds*self.time_scale)
+
+    def init(self):
+        pass
+
+    def exit(self):
+        pass
+
+    def get_single_config(self,key):
+        self._wait(self.config_latency)
+        widget = self.widgets[key]
+        return SimulatedWidget(key,widget.value,widget.choices)
+
+    def set_single_config(self,key,widget):
+        self._wait(self.config_latency)
+        self.widgets[key].value = widget.get_value()
+
+    def get_config(self):
+        self._wait(self.config_latency)
+        return SimulatedConfig(self.widgets)
+
+    def set_config(self,config):
+        self._wait(self.config_latency)
+        for name, widget in config.widgets.items():
+            self.widgets[name].value = widget.get_value()
+
+    def wait_for_event(self,timeout):
+        return self.GP_EVENT_TIMEOUT, None
+
+    def capture(self,capture_type):
+        iso = int(self.widgets["iso"].value)
+        exposure = float(Fraction(self.widgets["shutterspeed"].value))
+        self._wait(exposure+self.capture_overhead)
+        frame = self.sensor.frame(exposure,self.flux,gain=self.sensor.gain*iso/100)
+        buffer = io.BytesIO()
+        np.save(buffer,frame)
+        with self.lock:
+            self.n_captured += 1
+            name = f"IMG_{self.n_captured:04d}.npy"
+            self.files[name] = buffer.getvalue()
+        return SimulatedFilePath("/store_00010001/DCIM/100CANON",name)
+
+    def file_get(self,folder,name,file_type):
+        with self.lock:
+            data = self.files[name]
+        self._wait(len(data)/self.usb_bytes_per_s)
+        return SimulatedFile(data)
+
+    def file_delete(self,folder,name):
+        with self.lock:
+            del self.files[name]
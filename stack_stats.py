@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+def median_variance_bias(n):
+    """
+    Returns the median of the sample variance of n Gaussian samples over
+    the true variance, median(chi2(n-1))/(n-1), e.g. about 0.956 for 16
+    frames. Medians over pixels of a variance frame are biased low by it.
+    """
+    import scipy.stats
+    return scipy.stats.chi2.median(n-1)/(n-1)
+
+class StackStatsCalc:
+    """
+    Per-pixel mean and variance of a stack of frames.
+
+    Same interface as investigate_bias.OnlineStatsCalc, but frames are
+    buffered into a preallocated chunk of chunk_size frames. Each full chunk
+    is reduced to a mean and sum of squared deviations in one vectorized pass
+    and merged into the running totals with the parallel (Chan et al.)
+    variant of Welford's algorithm:
+
+        https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm
+
+    All work is done in place in the accumulator dtype (float32 or float64),
+    so no full-size temporaries are allocated after construction.
+    """
+
+    def __init__(self,shape,chunk_size=8,dtype="float64"):
+        if chunk_size < 1:
+            raise Exception(f"chunk_size must be at least 1, not {chunk_size}")
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = chunk_size
+        self.mean = np.zeros(self.shape,dtype=self.dtype)
+        self.ss = np.zeros(self.shape,dtype=self.dtype)
+        self.n = 0
+        # the chunk buffer and scratch space are allocated on first use
+        self._chunk = None
+        self._n_chunk = 0
+        self._chunk_mean = None
+        self._chunk_ss = None
+
+    def _allocate(self):
+        if self._chunk is None:
+            self._chunk = np.empty((self.chunk_size,)+self.shape,dtype=self.dtype)
+        self._allocate_scratch()
+
+    def _allocate_scratch(self):
+        if self._chunk_mean is None:
+            self._chunk_mean = np.empty(self.shape,dtype=self.dtype)
+            self._chunk_ss = np.empty(self.shape,dtype=self.dtype)
+
+    def release(self):
+        """
+        Flushes the chunk buffer and frees it and the scratch space, leaving
+        only the mean and sum of squares. They are allocated again if more
+        frames are added.
+        """
+        self._flush()
+        self._chunk = None
+        self._chunk_mean = None
+        self._chunk_ss = None
+
+    def add_sample(self,sample,scale=None):
+        self._allocate()
+        # integer frames are only promoted to the accumulator dtype here
+        self._chunk[self._n_chunk] = sample
+        if scale is not None:
+            self._chunk[self._n_chunk] *= scale
+        self._n_chunk += 1
+        if self._n_chunk == self.chunk_size:
+            self._flush()
+
+    def add_samples(self,samples):
+        for sample in samples:
+            self.add_sample(sample)
+
+    def merge(self,other):
+        """
+        Adds the frames accumulated by another StackStatsCalc to this one.
+        """
+        if other.shape != self.shape:
+            raise Exception(f"Can't merge stats of shape {other.shape} into {self.shape}")
+        self._flush()
+        other._flush()
+        if other.n == 0:
+            return
+        self._allocate_scratch()
+        np.copyto(self._chunk_mean,other.mean)
+        np.copyto(self._chunk_ss,other.ss)
+        self._merge_chunk(other.n)
+
+    def _flush(self):
+        k = self._n_chunk
+        if k == 0:
+            return
+        chunk = self._chunk[:k]
+        np.sum(chunk,axis=0,out=self._chunk_mean)
+        self._chunk_mean /= k
+        chunk -= self._chunk_mean
+        np.square(chunk,out=chunk)
+        np.sum(chunk,axis=0,out=self._chunk_ss)
+        self._n_chunk = 0
+        self._merge_chunk(k)
+
+    def _merge_chunk(self,n_b):
+        # merges the n_b frames summarized in self._chunk_mean and
+        # self._chunk_ss into the totals, using both as scratch space
+        n_a = self.n
+        n = n_a + n_b
+        if n_a == 0:
+            np.copyto(self.mean,self._chunk_mean)
+            np.copyto(self.ss,self._chunk_ss)
+            self.n = n
+            return
+        delta = self._chunk_mean
+        self.ss += self._chunk_ss
+        delta -= self.mean
+        np.multiply(delta,delta,out=self._chunk_ss)
+        self._chunk_ss *= n_a*n_b/n
+        self.ss += self._chunk_ss
+        delta *= n_b/n
+        self.mean += delta
+        self.n = n
+
+    @classmethod
+    def from_arrays(cls,n,mean,ss,chunk_size=8):
+        """
+        Returns a StackStatsCalc resuming from n frames with the given mean
+        and sum of squared deviations, e.g. as saved from an earlier run.
+        """
+        result = cls(mean.shape,chunk_size=chunk_size,dtype=mean.dtype)
+        result.n = n
+        result.mean = mean
+        result.ss = ss
+        return result
+
+    def __getstate__(self):
+        # the chunk buffer and scratch space are not worth pickling
+        self._flush()
+        return {"shape":self.shape,"dtype":self.dtype,"chunk_size":self.chunk_size,
+                "n":self.n,"mean":self.mean,"ss":self.ss}
+
+    def __setstate__(self,state):
+        self.__init__(state["shape"],chunk_size=state["chunk_size"],dtype=state["dtype"])
+        self.n = state["n"]
+        self.mean = state["mean"]
+        self.ss = state["ss"]
+
+    def get_mean(self):
+        self._flush()
+        return self.mean
+
+    def get_sample_std(self):
+        return np.sqrt(self.get_sample_variance())
+
+    def get_sample_variance(self):
+        self._flush()
+        return self.ss/(self.n-1)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import json
+import time
+import threading
+import contextlib
+import numpy as np
+
+class StageTimer:
+    """
+    Thread-safe record of how long each stage of a pipeline took, e.g. the
+    config change, capture, download, save, decode and stats of every frame
+    of an acquisition sweep.
+
+    Each record is a dict with the stage name, its start time (relative to
+    the timer's creation), duration in seconds, the thread it ran on and any
+    extra fields given, such as iso and shutter speed. Records can be
+    summarized per stage, histogrammed, or written out as JSON lines.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+        self.records = []
+
+    def record(self,stage,start,duration,**fields):
+        entry = {"stage":stage,"start":start-self.start_time,"duration":duration,
+                 "thread":threading.current_thread().name}
+        entry.update(fields)
+        with self.lock:
+            self.records.append(entry)
+
+    @contextlib.contextmanager
+    def time(self,stage,**fields):
+        """
+        Records the duration of the with block as stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage,start,time.perf_counter()-start,**fields)
+
+    def durations(self,stage):
+        with self.lock:
+            return np.array([entry["duration"] for entry in self.records if entry["stage"] == stage])
+
+    def stages(self):
+        """
+        Returns the stage names in the order they were first recorded.
+        """
+        with self.lock:
+            return list(dict.fromkeys(entry["stage"] for entry in self.records))
+
+    def summary(self):
+        """
+        Returns {stage: {"n", "total", "mean", "median", "p95", "max"}},
+        durations in seconds.
+        """
+        result = {}
+        for stage in self.stages():
+            durations = self.durations(stage)
+            result[stage] = {"n":len(durations),"total":float(durations.sum()),"mean":float(durations.mean()),
+                             "median":float(np.median(durations)),"p95":float(np.percentile(durations,95)),
+                             "max":float(durations.max())}
+        return result
+
+    def histogram(self,stage,bins=20):
+        """
+        Returns (counts, bin edges) of the durations of stage.
+        """
+        return np.histogram(self.durations(stage),bins=bins)
+
+    def report(self):
+        """
+        Returns the summary as a table, with each stage's share of the wall
+        time since the timer was created. Stages running in parallel threads
+        overlap, so the shares can add up to more than 100%.
+        """
+        wall_time = time.perf_counter()-self.start_time
+        result = f"{'stage':10} {'n':>6} {'total [s]':>10} {'mean [s]':>9} {'median [s]':>10} {'p95 [s]':>9} {'max [s]':>9} {'wall %':>7}"
+        for stage, s in self.summary().items():
+            result += (f"\n{stage:10} {s['n']:6d} {s['total']:10.3f} {s['mean']:9.4f} {s['median']:10.4f}"
+                       f" {s['p95']:9.4f} {s['max']:9.4f} {100*s['total']/wall_time:7.1f}")
+        return result
+
+    def write_log(self,path):
+        """
+        Writes every record to path as one JSON object per line.
+        """
+        with self.lock:
+            records = list(self.records)
+        with open(path,"w") as outfile:
+            for entry in records:
+                outfile.write(json.dumps(entry)+"\n")
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+from stack_stats import StackStatsCalc
+from raw_cache import read_raw
+
+def decode_frames(fns,cache=None):
+    """
+    Yields the uint16 raw Bayer image of each file in fns, skipping (and
+    reporting) files that can't be decoded. With a raw_cache.RawCache the
+    frames are memory maps, so nothing is read until a frame is used.
+    """
+    for fn in fns:
+        try:
+            img = read_raw(fn,cache=cache)
+        except Exception:
+            print(f"Error reading image: {fn}")
+            continue
+        yield img
+
+def crop_frames(frames,roi=None):
+    """
+    Yields a view of each frame cropped to roi (a tuple of slices).
+    """
+    for frame in frames:
+        if roi is None:
+            yield frame
+        else:
+            yield frame[roi]
+
+def accumulate_frames(frames,gain=None,chunk_frames=8,dtype="float64",n_frames=None):
+    """
+    Reduces a stream of (integer) frames into a StackStatsCalc, dividing by
+    gain if given. Frames are only promoted to dtype when they are copied
+    into the accumulator's chunk buffer of chunk_frames frames (no more than
+    n_frames, the length of the stream, if known), so memory use is about
+    chunk_frames+4 frames in dtype. The buffer is freed once the stream
+    ends. Returns None if the stream is empty.
+    """
+    stats = None
+    for frame in frames:
+        if stats is None:
+            chunk_size = chunk_frames
+            if n_frames is not None:
+                chunk_size = max(1,min(chunk_size,n_frames))
+            stats = StackStatsCalc(frame.shape,chunk_size=chunk_size,dtype=dtype)
+        stats.add_sample(frame,scale=(1./gain if gain else None))
+    if stats is not None:
+        stats.release()
+    return stats
@@ -1,31 +1,65 @@
 #!/usr/bin/env python3
 
-import rawpy
-import imageio
-import pyexiv2
-import sys
-import gphoto2 as gp
-import glob
 import os
-import shutil
+import io
+import re
+import functools
 from fractions import Fraction
-import tempfile
+import queue
+import threading
+import contextlib
+import concurrent.futures
 import numpy as np
-import matplotlib.pyplot as plt
 
-from investigate_bias import get_stats
+from frame_stats import FrameStats, get_stats
+from exposure_planner import ExposurePlanner
+from session_manifest import SessionManifest
+from stage_timer import StageTimer
 
 def shutterspeed_to_float(x):
     return float(Fraction(x))
 
 class Camera:
+    """
+    Wrapper around a gphoto2 camera.
 
-    def __init__(self):
-        self.camera = gp.Camera()
-        self.camera.init()
+    Config widgets, their values and their choices are cached after the
+    first read, so reading a value or setting it to what it already is costs
+    no PTP round trip. Property changes the camera reports (see poll_events)
+    update or drop the cached values; choice lists are kept.
+
+    If timer (a StageTimer) is given, config changes, captures and
+    downloads are recorded in it, as are saving and analyzing frames in a
+    CapturePipeline using this camera.
+    """
 
-        self.iso_config = self.camera.get_single_config("iso")
-        self.shutterspeed_config = self.camera.get_single_config("shutterspeed")
+    def __init__(self,port=None,model=None,backend=None,timer=None):
+        """
+        Opens the camera at port (e.g. "usb:001,005", see
+        multi_camera.list_cameras) or, if port is None, the first one found.
+        backend replaces the gphoto2.Camera, e.g. with a
+        simulated_camera.SimulatedCamera, and must then also have the
+        gphoto2 GP_EVENT_*, GP_CAPTURE_IMAGE and GP_FILE_TYPE_NORMAL
+        constants as attributes.
+        """
+        self.timer = timer
+        if backend is None:
+            import gphoto2 as gp
+            self.gp = gp
+            self.camera = gp.Camera()
+            if model is not None:
+                abilities_list = gp.CameraAbilitiesList()
+                abilities_list.load()
+                self.camera.set_abilities(abilities_list[abilities_list.lookup_model(model)])
+            if port is not None:
+                port_info_list = gp.PortInfoList()
+                port_info_list.load()
+                self.camera.set_port_info(port_info_list[port_info_list.lookup_path(port)])
+        else:
+            self.gp = backend
+            self.camera = backend
+        self.camera.init()
+        self.invalidate_config_cache()
 
     def __del__(self):
         self.camera.exit()
@@ -33,98 +67,391 @@ class Camera:
     def __str__(self):
         result = "Camera("
         for key in ["iso","bulb","shutterspeed","aperture"]:
-            value = self.camera.get_single_config(key).get_value()
+            value = self.get_config_val(key)
             result += f"{key}={value},"
         result = result[:-1] + ")"
         return result
 
-    def set_iso(self,val):
-        allowed_choices = list(self.iso_config.get_choices())
+    @property
+    def raw_extension(self):
+        """
+        Extension of the captured files, ".cr2" unless the backend says
+        otherwise.
+        """
+        return getattr(self.camera,"raw_extension",".cr2")
+
+    def time(self,stage,**fields):
+        """
+        Returns a context manager recording its block as stage in the timer,
+        if there is one.
+        """
+        if self.timer is None:
+            return contextlib.nullcontext()
+        return self.timer.time(stage,**fields)
+
+    def invalidate_config_cache(self):
+        self._widgets = {}
+        self._values = {}
+        self._choices = {}
+        self._config_tree = None
+
+    def invalidate_config_values(self):
+        self._values = {}
+        self._config_tree = None
+
+    def poll_events(self):
+        """
+        Drains pending camera events. File and capture events are ignored.
+        A property change naming the property and its new value, as newer
+        libgphoto2 versions report them ('PTP Property d103 changed, "iso"
+        to "800"'), updates that cached value; any other event drops all
+        cached values.
+        """
+        gp = self.gp
+        while True:
+            event_type, event_data = self.camera.wait_for_event(0)
+            if event_type == gp.GP_EVENT_TIMEOUT:
+                return
+            if event_type in [gp.GP_EVENT_FILE_ADDED,gp.GP_EVENT_FOLDER_ADDED,
+                              gp.GP_EVENT_FILE_CHANGED,gp.GP_EVENT_CAPTURE_COMPLETE]:
+                continue
+            match = re.search(r'changed, "([^"]*)" to "([^"]*)"',str(event_data))
+            if match is None:
+                self.invalidate_config_values()
+                continue
+            key, value = match.groups()
+            if key in self._values and self._values[key] != value:
+                self._values[key] = value
+                self._widgets[key].set_value(value)
+                self._config_tree = None
+
+    def _read_widget(self,key):
+        widget = self.camera.get_single_config(key)
+        self._widgets[key] = widget
+        self._values[key] = widget.get_value()
+
+    def _get_widget(self,key):
+        if not (key in self._widgets):
+            self._read_widget(key)
+        return self._widgets[key]
+
+    def get_config_val(self,key):
+        if not (key in self._values):
+            self._read_widget(key)
+        return self._values[key]
+
+    def get_choices(self,key):
+        if not (key in self._choices):
+            self._choices[key] = list(self._get_widget(key).get_choices())
+        return self._choices[key]
+
+    def _check_choice(self,key,val):
+        allowed_choices = self.get_choices(key)
         if not (val in allowed_choices):
-            exceptionStr = f"{val} is not one of the allowed iso choices: {allowed_choices}"
+            exceptionStr = f"{val} is not one of the allowed {key} choices: {allowed_choices}"
             raise Exception(exceptionStr)
-        self.iso_config.set_value(val)
-        self.camera.set_single_config("iso",self.iso_config)
+
+    def set_iso(self,val):
+        self.set_config_val("iso",val)
 
     def set_shutterspeed(self,val):
-        allowed_choices = list(self.shutterspeed_config.get_choices())
-        if not (val in allowed_choices):
-            exceptionStr = f"{val} is not one of the allowed shutterspeed choices: {allowed_choices}"
-            raise Exception(exceptionStr)
-        self.shutterspeed_config.set_value(val)
-        self.camera.set_single_config("shutterspeed",self.shutterspeed_config)
+        self.set_config_val("shutterspeed",val)
 
     def get_isos(self):
-        return list(self.iso_config.get_choices())
+        return list(self.get_choices("iso"))
 
     def get_shutterspeeds(self):
-        return list(self.shutterspeed_config.get_choices())
+        return list(self.get_choices("shutterspeed"))
 
     def set_config_val(self,key,val):
-        camera = self.camera
-        config = camera.get_single_config(key)
-        allowed_choices = config.get_choices()
-        if not (val in allowed_choices):
-            exceptionStr = f"{val} is not one of the allowed choices: {list(allowed_choices)}"
-            raise Exception(exceptionStr)
-        config.set_value(val)
-        camera.set_single_config(key,config)
+        self.set_config_vals({key:val})
 
-    def capture_image(self,outfn):
-        camera_file_path = self.camera.capture(gp.GP_CAPTURE_IMAGE)
-        camera_file = self.camera.file_get(camera_file_path.folder, camera_file_path.name, gp.GP_FILE_TYPE_NORMAL)
-        camera_file.save(outfn)
+    def set_config_vals(self,values):
+        """
+        Sets several config values, e.g. {"iso":"800","shutterspeed":"30"},
+        skipping the ones that already have that value. More than one change
+        is written to the camera in a single set_config call. Values dropped
+        from the cache by poll_events are written without reading them
+        first, one by one, as the config tree is stale too.
+        """
+        changed = {}
+        for key, val in values.items():
+            self._check_choice(key,val)
+            if self._values.get(key) != val:
+                changed[key] = val
+        if len(changed) == 0:
+            return
+        with self.time("config",**changed):
+            if len(changed) == 1 or not all(key in self._values for key in changed):
+                for key, val in changed.items():
+                    widget = self._get_widget(key)
+                    widget.set_value(val)
+                    self.camera.set_single_config(key,widget)
+            else:
+                if self._config_tree is None:
+                    self._config_tree = self.camera.get_config()
+                for key, val in changed.items():
+                    self._config_tree.get_child_by_name(key).set_value(val)
+                    self._widgets[key].set_value(val)
+                self.camera.set_config(self._config_tree)
+        self._values.update(changed)
+
+    def capture_file(self):
+        """
+        Captures an image and downloads it, returning the gphoto2 CameraFile.
+        The image is deleted from the camera's card.
+        """
+        gp = self.gp
+        fields = {"iso":self._values.get("iso"),"shutterspeed":self._values.get("shutterspeed")}
+        with self.time("capture",**fields):
+            camera_file_path = self.camera.capture(gp.GP_CAPTURE_IMAGE)
+        with self.time("download",**fields):
+            camera_file = self.camera.file_get(camera_file_path.folder, camera_file_path.name, gp.GP_FILE_TYPE_NORMAL)
         self.camera.file_delete(camera_file_path.folder, camera_file_path.name)
+        self.poll_events()
+        return camera_file
+
+    def capture_image(self,outfn):
+        self.capture_file().save(outfn)
+
+    def capture_to_buffer(self):
+        """
+        Captures an image and returns the raw file's contents as bytes,
+        without writing anything to disk.
+        """
+        camera_file = self.capture_file()
+        return bytes(camera_file.get_data_and_size())
+
+class CapturePipeline:
+    """
+    Overlaps camera exposures with saving and analyzing earlier frames.
+
+    Jobs are run in submission order on a single camera thread, which sets
+    the ISO and shutter speed, captures and downloads the file into memory.
+    Downloaded frames are passed to a writer thread that writes them to disk
+    once, records them in manifest (a SessionManifest) if given, and runs the
+    job's analyze function on the in-memory data. Both hand-offs go through
+    queues of at most max_pending entries, so a slow disk makes submit() and
+    the camera wait rather than piling up frames in memory.
 
-def take_flat_data(camera, N):
-    iso_choices = reversed(camera.get_isos()[1:])
+    Use as a context manager; leaving it waits for all submitted jobs.
+    """
+
+    def __init__(self,camera,max_pending=4,manifest=None):
+        self.camera = camera
+        self.manifest = manifest
+        self.jobs = queue.Queue(maxsize=max_pending)
+        self.downloads = queue.Queue(maxsize=max_pending)
+        self.camera_thread = threading.Thread(target=self._run_camera,daemon=True)
+        self.writer_thread = threading.Thread(target=self._run_writer,daemon=True)
+        self.camera_thread.start()
+        self.writer_thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+
+    def submit(self,iso,shutterspeed,outfn,analyze=None,index=None):
+        """
+        Queues a capture at iso and shutterspeed saved to outfn, recorded in
+        the manifest as frame index. Returns a concurrent.futures.Future that
+        resolves, once the file is saved, to analyze(data), where data are
+        the file's bytes, or to outfn if analyze is None.
+        """
+        future = concurrent.futures.Future()
+        self.jobs.put((iso,shutterspeed,outfn,analyze,index,future))
+        return future
+
+    def close(self):
+        self.jobs.put(None)
+        self.camera_thread.join()
+        self.writer_thread.join()
+
+    def _run_camera(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.downloads.put(None)
+                return
+            iso, shutterspeed, outfn, analyze, index, future = job
+            try:
+                self.camera.set_config_vals({"iso":iso,"shutterspeed":shutterspeed})
+                data = self.camera.capture_to_buffer()
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            self.downloads.put((data,job))
+
+    def _run_writer(self):
+        while True:
+            item = self.downloads.get()
+            if item is None:
+                return
+            data, (iso, shutterspeed, outfn, analyze, index, future) = item
+            try:
+                with self.camera.time("save",iso=iso,shutterspeed=shutterspeed):
+                    with open(outfn,"wb") as outfile:
+                        outfile.write(data)
+                    if self.manifest is not None and index is not None:
+                        self.manifest.record(iso,shutterspeed,index,outfn,data)
+                if analyze is None:
+                    future.set_result(outfn)
+                else:
+                    future.set_result(analyze(data))
+            except Exception as e:
+                future.set_exception(e)
+
+def decode_raw_data(data):
+    """
+    Returns the raw Bayer image and white level of a raw file's contents.
+    The .npy frames of a simulated camera have no white level, so it is
+    None for them.
+    """
+    if data[:6] == b"\x93NUMPY":
+        return np.load(io.BytesIO(data)), None
+    import rawpy
+    with rawpy.imread(io.BytesIO(data)) as raw:
+        return raw.raw_image.copy(), raw.white_level
+
+def flat_frame_stats(data,timer=None):
+    """
+    Returns (FrameStats of the central ROI, white level) of a raw file's
+    contents, or None if it can't be decoded, recording the decode and
+    stats stages in timer if given.
+    """
+    with (timer.time("decode") if timer else contextlib.nullcontext()):
+        try:
+            image, white_level = decode_raw_data(data)
+        except Exception as e:
+            print(f"Error decoding image: {e}")
+            return None
+    with (timer.time("stats") if timer else contextlib.nullcontext()):
+        stats = FrameStats()
+        stats.add(image[1000:2024,1000:2024])
+    return stats, white_level
+
+def take_flat_setting(pipeline, iso, shutterspeed, N, futures, root=".", progress=None):
+    """
+    Captures N flat frames at iso and shutterspeed, checking the first one
+    before queuing the rest, whose futures are appended to futures. Frames
+    that pipeline.manifest already has are not captured again.
+    Returns (stats, white_level) of the first frame, "saturated" if it was
+    saturated (and deleted) or None if it couldn't be read.
+    """
+    manifest = pipeline.manifest
+    if manifest is not None and manifest.is_saturated(iso,shutterspeed):
+        return "saturated"
+    shutterspeed_for_fn = shutterspeed
+    if "/" in shutterspeed_for_fn:
+        shutterspeed_for_fn = shutterspeed_for_fn[2:] + "th"
+    elif "." in shutterspeed_for_fn:
+        shutterspeed_for_fn = shutterspeed_for_fn.replace('.','p')
+    dirname = os.path.join(root,f"walldata/ISO{iso}/shutter{shutterspeed_for_fn}")
+    fname_base = os.path.join(dirname,f"wall_ISO{iso}_shutter{shutterspeed_for_fn}_")
+    #print(f"ISO: {iso} shutter speed: {shutterspeed}")
+    try:
+        os.makedirs(dirname)
+    except FileExistsError:
+        pass
+    extension = pipeline.camera.raw_extension
+    first_fn = fname_base + "0001" + extension
+    analyze = functools.partial(flat_frame_stats,timer=pipeline.camera.timer)
+    if manifest is not None and manifest.is_complete(iso,shutterspeed,1):
+        with open(first_fn,"rb") as infile:
+            result = analyze(infile.read())
+    else:
+        # capture errors are raised here, stopping the sweep
+        result = pipeline.submit(iso,shutterspeed,first_fn,analyze=analyze,index=1).result()
+    if result is None:
+        print(f"Error reading image: {first_fn}")
+        return None
+    stats, white_level = result
+    #if stats.get_percentiles([1.])[0] < 280.:
+    #    return None
+    if stats.get_percentiles([99])[0] == stats.get_max():
+        if manifest is not None:
+            manifest.mark_saturated(iso,shutterspeed)
+        os.remove(first_fn)
+        try:
+            os.rmdir(dirname)
+        except OSError:
+            pass
+        return "saturated"
+    print(f"{iso:4} {shutterspeed:14} "+get_stats(stats,table=True),flush=True)
+    if progress:
+        progress.advance()
+    for i in range(2,N+1):
+        fname = f"{fname_base}{i:04d}{extension}"
+        #print(fname)
+        if manifest is not None and manifest.is_complete(iso,shutterspeed,i):
+            if progress:
+                progress.advance()
+            continue
+        futures.append(pipeline.submit(iso,shutterspeed,fname,index=i))
+        if progress:
+            futures[-1].add_done_callback(lambda future: progress.advance())
+    return stats, white_level
+
+def take_flat_data(camera, N, plan=False, n_points=10, pairs=False, root=".", progress=None):
+    """
+    Takes N flat frames at each ISO and shutter speed, stopping at the first
+    saturated shutter speed. With plan=True, only a few probe exposures plus
+    about n_points exposures chosen by an ExposurePlanner are taken per ISO.
+    With pairs=True, only the two frames per exposure that find_gain.py's
+    pair difference method needs are taken, whatever N is.
+    Frames are saved under root/walldata and recorded in the session
+    manifest root/walldata/session.json; rerunning an interrupted sweep
+    resumes it from the first missing frame. progress, if given, is a
+    multi_camera.DeviceProgress; since the sweep stops at saturation, its
+    total is an upper bound.
+    """
+    if pairs:
+        N = 2
+    iso_choices = list(reversed(camera.get_isos()[1:]))
     shutterspeed_choices = list(reversed(camera.get_shutterspeeds()))
+    shutterspeed_choices.pop(shutterspeed_choices.index("bulb"))
     shutterspeed_choices = shutterspeed_choices[15:]
     print(shutterspeed_choices)
+    if progress:
+        n_settings = min(len(shutterspeed_choices),n_points+3) if plan else len(shutterspeed_choices)
+        progress.set_total(len(iso_choices)*n_settings*N)
     
     print(f"{'iso':4} {'shutterspeed':14} "+get_stats(None,table_header=True))
-    for iso in iso_choices:
-        for shutterspeed in shutterspeed_choices:
-            shutterspeed_for_fn = shutterspeed
-            if "/" in shutterspeed_for_fn:
-                shutterspeed_for_fn = shutterspeed_for_fn[2:] + "th"
-            elif "." in shutterspeed_for_fn:
-                shutterspeed_for_fn = shutterspeed_for_fn.replace('.','p')
-            dirname = f"walldata/ISO{iso}/shutter{shutterspeed_for_fn}"
-            fname_base = os.path.join(dirname,f"wall_ISO{iso}_shutter{shutterspeed_for_fn}_")
-            #print(f"ISO: {iso} shutter speed: {shutterspeed}")
-            camera.set_iso(iso)
-            camera.set_shutterspeed(shutterspeed)
-            with tempfile.NamedTemporaryFile() as tmpf:
-                fname = tmpf.name
-                camera.capture_image(fname)
-                #print(f"  image captured into {fname}")
-                img = None
-                with rawpy.imread(fname) as raw:
-                    try:
-                        img = np.array(raw.raw_image[1000:2024,1000:2024],dtype="float32")
-                    except Exception:
-                        print(f"Error reading image: {fn}")
-                        continue
-                #if np.percentile(img,1.) < 280.:
-                #    continue
-                if np.percentile(img,99) == np.max(img):
+    futures = []
+    manifest = SessionManifest(os.path.join(root,"walldata","session.json"))
+    with CapturePipeline(camera,manifest=manifest) as pipeline:
+        for iso in iso_choices:
+            if plan:
+                planner = ExposurePlanner([shutterspeed_to_float(x) for x in shutterspeed_choices],n_points=n_points)
+                to_take = planner.probes()
+            else:
+                to_take = list(range(len(shutterspeed_choices)))
+            i_take = 0
+            while i_take < len(to_take):
+                shutterspeed = shutterspeed_choices[to_take[i_take]]
+                i_take += 1
+                result = take_flat_setting(pipeline,iso,shutterspeed,N,futures,root=root,progress=progress)
+                if result == "saturated":
                     break
-                print(f"{iso:4} {shutterspeed:14} "+get_stats(img,table=True),flush=True)
-                try:
-                    os.makedirs(dirname)
-                except FileExistsError:
-                    pass
-                copy_fn = fname_base + "0001.cr2"
-                #print(copy_fn)
-                shutil.copyfile(fname,copy_fn)
-            for i in range(2,N+1):
-                fname = f"{fname_base}{i:04d}.cr2"
-                #print(fname)
-                camera.capture_image(fname)
-
-def take_dark_data(camera, N):
-    iso_choices = reversed(camera.get_isos()[1:])
+                if plan and result is not None:
+                    stats, white_level = result
+                    planner.add_probe(shutterspeed_to_float(shutterspeed),stats.get_mean(),white_level)
+                if plan and i_take == len(planner.probes()):
+                    to_take += planner.plan()
+    for future in futures:
+        future.result()
+
+def take_dark_data(camera, N, root=".", progress=None):
+    """
+    Takes N dark frames at each ISO and at the shortest and all 1 s or longer
+    shutter speeds, saved under root/darkdata. Frames already recorded in
+    the session manifest root/darkdata/session.json are skipped, so an
+    interrupted sweep can just be rerun. progress, if given, is a
+    multi_camera.DeviceProgress.
+    """
+    iso_choices = list(reversed(camera.get_isos()[1:]))
     shutterspeed_choices = list(reversed(camera.get_shutterspeeds()))
     shutterspeed_choices.pop(shutterspeed_choices.index("bulb"))
     shutterspeed_choices_float = np.array([shutterspeed_to_float(x) for x in shutterspeed_choices])
@@ -135,33 +462,55 @@ def take_dark_data(camera, N):
             shutterspeeds_to_use.append(shutterspeed_choices[i])
     #shutterspeeds_to_use = ["1/4000","1","5","15"]
     print("Using shutterspeeds: ", shutterspeeds_to_use)
+    if progress:
+        progress.set_total(len(iso_choices)*len(shutterspeeds_to_use)*N)
     
-    for iso in iso_choices:
-        for shutterspeed in shutterspeeds_to_use:
-            shutterspeed_for_fn = shutterspeed
-            if "/" in shutterspeed_for_fn:
-                shutterspeed_for_fn = shutterspeed_for_fn[2:] + "th"
-            elif "." in shutterspeed_for_fn:
-                shutterspeed_for_fn = shutterspeed_for_fn.replace('.','p')
-            dirname = f"darkdata/ISO{iso}/shutter{shutterspeed_for_fn}"
-            fname_base = os.path.join(dirname,f"dark_ISO{iso}_shutter{shutterspeed_for_fn}_")
-            print(f"ISO: {iso} shutter speed: {shutterspeed}",flush=True)
-            camera.set_iso(iso)
-            camera.set_shutterspeed(shutterspeed)
-            try:
-                os.makedirs(dirname)
-            except FileExistsError:
-                pass
-            for i in range(1,N+1):
-                fname = f"{fname_base}{i:04d}.cr2"
-                #print(fname)
-                camera.capture_image(fname)
+    futures = []
+    manifest = SessionManifest(os.path.join(root,"darkdata","session.json"))
+    with CapturePipeline(camera,manifest=manifest) as pipeline:
+        for iso in iso_choices:
+            for shutterspeed in shutterspeeds_to_use:
+                shutterspeed_for_fn = shutterspeed
+                if "/" in shutterspeed_for_fn:
+                    shutterspeed_for_fn = shutterspeed_for_fn[2:] + "th"
+                elif "." in shutterspeed_for_fn:
+                    shutterspeed_for_fn = shutterspeed_for_fn.replace('.','p')
+                dirname = os.path.join(root,f"darkdata/ISO{iso}/shutter{shutterspeed_for_fn}")
+                fname_base = os.path.join(dirname,f"dark_ISO{iso}_shutter{shutterspeed_for_fn}_")
+                print(f"ISO: {iso} shutter speed: {shutterspeed}",flush=True)
+                try:
+                    os.makedirs(dirname)
+                except FileExistsError:
+                    pass
+                for i in range(1,N+1):
+                    fname = f"{fname_base}{i:04d}{camera.raw_extension}"
+                    #print(fname)
+                    if manifest.is_complete(iso,shutterspeed,i):
+                        if progress:
+                            progress.advance()
+                        continue
+                    futures.append(pipeline.submit(iso,shutterspeed,fname,index=i))
+                    if progress:
+                        futures[-1].add_done_callback(lambda future: progress.advance())
+    for future in futures:
+        future.result()
 
 if __name__ == "__main__":
 
-    camera = Camera()
+    # run against a simulated camera, e.g. to profile the sweep, and report
+    # where the time goes
+    simulate = False
+    timer = StageTimer()
+    if simulate:
+        from simulated_camera import SimulatedCamera
+        camera = Camera(backend=SimulatedCamera(flux=0.,time_scale=0.1),timer=timer)
+    else:
+        camera = Camera(timer=timer)
 
     N = 10
 
     #take_flat_data(camera,N)
+    #take_flat_data(camera,N,pairs=True)
     take_dark_data(camera,N)
+    print(timer.report())
+    timer.write_log("take_data_timing.jsonl")
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+import os
+import concurrent.futures
+import numpy as np
+from raw_cache import RawCache
+from stream_pipeline import decode_frames, crop_frames, accumulate_frames
+
+def row_bands(n_rows,band_rows):
+    """
+    Returns (first row, end row) of each band of band_rows rows.
+    """
+    return [(r0,min(r0+band_rows,n_rows)) for r0 in range(0,n_rows,band_rows)]
+
+def _cache_frame(fn,cache):
+    try:
+        return cache.get(fn).shape
+    except Exception:
+        print(f"Error reading image: {fn}")
+        return None
+
+def _reduce_band(fns,cache,r0,r1,mean_fn,std_fn,dtype,chunk_frames):
+    frames = crop_frames(decode_frames(fns,cache=cache),roi=(slice(r0,r1),slice(None)))
+    stats = accumulate_frames(frames,chunk_frames=chunk_frames,dtype=dtype,n_frames=len(fns))
+    mean_out = np.load(mean_fn,mmap_mode="r+")
+    std_out = np.load(std_fn,mmap_mode="r+")
+    mean_out[r0:r1] = stats.get_mean()
+    std_out[r0:r1] = stats.get_sample_std()
+    mean_out.flush()
+    std_out.flush()
+    return stats.n
+
+def tiled_stack_stats(fns,out_prefix,cache=None,band_rows=256,n_workers=None,dtype="float32",chunk_frames=8):
+    """
+    Builds the per-pixel mean and sample standard deviation frames of the
+    stack fns one band of band_rows sensor rows at a time.
+
+    Every frame is decoded once into cache (a RawCache, which must be big
+    enough to hold the whole stack), then each band is reduced from the
+    memory-mapped frames and written straight into out_prefix+"_mean.npy"
+    and out_prefix+"_std.npy". Bands are spread over n_workers processes,
+    each buffering chunk_frames frames of its band, so memory use is about
+    chunk_frames+3 bands per worker, however big the sensor.
+
+    Returns the two output frames, memory mapped read-only, and the number
+    of frames that could be read.
+    """
+    if cache is None:
+        cache = RawCache()
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    fns = sorted(fns)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+        shapes = list(executor.map(_cache_frame,fns,[cache]*len(fns)))
+        fns = [fn for fn, shape in zip(fns,shapes) if shape is not None]
+        if len(fns) == 0:
+            raise Exception(f"None of the frames for {out_prefix} could be read")
+        shape = [shape for shape in shapes if shape is not None][0]
+        mean_fn = out_prefix+"_mean.npy"
+        std_fn = out_prefix+"_std.npy"
+        os.makedirs(os.path.dirname(mean_fn) or ".",exist_ok=True)
+        for fn in [mean_fn,std_fn]:
+            out = np.lib.format.open_memmap(fn,mode="w+",dtype=dtype,shape=shape)
+            del out
+        futures = [executor.submit(_reduce_band,fns,cache,r0,r1,mean_fn,std_fn,dtype,chunk_frames)
+                   for r0, r1 in row_bands(shape[0],band_rows)]
+        for future in futures:
+            future.result()
+    return np.load(mean_fn,mmap_mode="r"), np.load(std_fn,mmap_mode="r"), len(fns)
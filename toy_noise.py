@@ -1,9 +1,6 @@
 #!/usr/bin/env python3
 
 import numpy as np
-import scipy
-import scipy.stats
-import matplotlib.pyplot as plt
 
 
 def linear_fit(x,y,printinfo=True):
@@ -21,55 +18,97 @@ def linear_fit(x,y,printinfo=True):
     if len(x) != len(y):
         raise Exception("Length of x and y data must be the same!")
 
-    x = scipy.array(x)
-    y = scipy.array(y)
-    N = len(x)
-    meanx = scipy.mean(x)
-    meany = scipy.mean(y)
-    variancex = sum((x-meanx)**2)
-    variancey = sum((y-meany)**2)
-    covariance = sum((x-meanx)*(y-meany))
+    results = linear_fit_batch(np.asarray(x)[np.newaxis],np.asarray(y)[np.newaxis],printinfo=printinfo)
+    return tuple(float(result[0]) for result in results)
 
-    slope = covariance / variancex
-    intercept = meany - meanx*slope
-    r2 = covariance**2 / variancex / variancey
+def linear_fit_batch(x,y,weights=None,mask=None,printinfo=False):
+    """
+    Fits y = slope*x+intercept to every series (row) of y at once.
 
-    residuals = y - (slope*x+intercept)
-    yvariance = sum(residuals**2/(N-2))
+    y has shape (n_series, n_points) and x the same shape or (n_points,) if
+    shared by all series. Ragged series are padded and masked out, either
+    with mask (True where a point is used) or with NaN in x or y. weights
+    (same shape as y, e.g. 1/sigma^2) make it a weighted least squares fit;
+    the errors are then scaled by the weighted residuals, so with all
+    weights 1 everything matches linear_fit exactly.
 
-    slopevariance = yvariance/variancex
-    interceptvariance = slopevariance * sum(x**2 / N)
-    
-    slopeerror = scipy.sqrt(slopevariance)
-    intercepterror = scipy.sqrt(interceptvariance)
-    yerr = scipy.sqrt(yvariance)
+    Returns arrays of shape (n_series,) of slope, intercept, slope error,
+    intercept error and y error. Series with fewer than 3 points get NaN
+    errors, and fewer than 2 NaN everything. printinfo prints linear_fit's
+    report for every series.
+    """
+    y = np.asarray(y,dtype="float64")
+    x = np.broadcast_to(np.asarray(x,dtype="float64"),y.shape)
+    if weights is None:
+        weights = np.ones(y.shape)
+    else:
+        weights = np.broadcast_to(np.asarray(weights,dtype="float64"),y.shape)
+    use = np.isfinite(x) & np.isfinite(y)
+    if mask is not None:
+        use &= np.broadcast_to(mask,y.shape)
+    weights = np.where(use,weights,0.)
+    x = np.where(use,x,0.)
+    y = np.where(use,y,0.)
+    N = use.sum(axis=1)
+
+    with np.errstate(divide="ignore",invalid="ignore"):
+        sumw = weights.sum(axis=1)
+        meanx = (weights*x).sum(axis=1)/sumw
+        meany = (weights*y).sum(axis=1)/sumw
+        dx = np.where(use,x-meanx[:,np.newaxis],0.)
+        dy = np.where(use,y-meany[:,np.newaxis],0.)
+        variancex = (weights*dx**2).sum(axis=1)
+        variancey = (weights*dy**2).sum(axis=1)
+        covariance = (weights*dx*dy).sum(axis=1)
+
+        slope = covariance / variancex
+        intercept = meany - meanx*slope
+        r2 = covariance**2 / variancex / variancey
+
+        residuals = np.where(use,y - (slope[:,np.newaxis]*x+intercept[:,np.newaxis]),0.)
+        yvariance = (weights*residuals**2).sum(axis=1)/(N-2)
+        yvariance[N <= 2] = np.nan
+
+        slopevariance = yvariance/variancex
+        interceptvariance = slopevariance * (weights*x**2).sum(axis=1)/sumw
+
+        slopeerror = np.sqrt(slopevariance)
+        intercepterror = np.sqrt(interceptvariance)
+        yerr = np.sqrt(yvariance)
 
     if printinfo:
-      onesigtailProb = scipy.stats.norm.sf(1)
-      up1sigChiVal = scipy.stats.chi.ppf(onesigtailProb,df=N-2)
-      down1sigChiVal = scipy.stats.chi.isf(onesigtailProb,df=N-2)
-      yerrupBound =  yerr*(scipy.sqrt(N-2)/up1sigChiVal - 1)
-      yerrdownBound =  yerr*(1 - scipy.sqrt(N-2)/down1sigChiVal)
-      #yerrupBound =  scipy.sqrt(N-2)*yerr/up1sigChiVal
-      #yerrdownBound =  scipy.sqrt(N-2)*yerr/down1sigChiVal
-      #print(onesigtailProb)
-      #print(up1sigChiVal)
-      #print(down1sigChiVal)
-      print("#"*80)
-      print("Linear Fit Results for {} Data Points".format(N))
-      print("slope estimate:               {:10.5g} +/- {:10.5g}".format(slope,slopeerror))
-      print("intercept estimate:           {:10.5g} +/- {:10.5g}".format(intercept,intercepterror))
-      print("y point uncertainty estimate: {:10.5g}   +{:<10.5g} -{:<10.5g}".format(yerr,yerrupBound,yerrdownBound))
-      print("r^2:                          {:10.5g}".format(r2))
-      print("#"*80)
+      for i in range(len(slope)):
+        _print_fit(N[i],slope[i],intercept[i],slopeerror[i],intercepterror[i],yerr[i],r2[i])
 
     return slope, intercept, slopeerror, intercepterror, yerr
 
+def _print_fit(N,slope,intercept,slopeerror,intercepterror,yerr,r2):
+    import scipy.stats
+    onesigtailProb = scipy.stats.norm.sf(1)
+    up1sigChiVal = scipy.stats.chi.ppf(onesigtailProb,df=N-2)
+    down1sigChiVal = scipy.stats.chi.isf(onesigtailProb,df=N-2)
+    yerrupBound =  yerr*(np.sqrt(N-2)/up1sigChiVal - 1)
+    yerrdownBound =  yerr*(1 - np.sqrt(N-2)/down1sigChiVal)
+    #yerrupBound =  np.sqrt(N-2)*yerr/up1sigChiVal
+    #yerrdownBound =  np.sqrt(N-2)*yerr/down1sigChiVal
+    #print(onesigtailProb)
+    #print(up1sigChiVal)
+    #print(down1sigChiVal)
+    print("#"*80)
+    print("Linear Fit Results for {} Data Points".format(N))
+    print("slope estimate:               {:10.5g} +/- {:10.5g}".format(slope,slopeerror))
+    print("intercept estimate:           {:10.5g} +/- {:10.5g}".format(intercept,intercepterror))
+    print("y point uncertainty estimate: {:10.5g}   +{:<10.5g} -{:<10.5g}".format(yerr,yerrupBound,yerrdownBound))
+    print("r^2:                          {:10.5g}".format(r2))
+    print("#"*80)
+
 def plot_linear_fit(ax, xdata, slope,intercept,slopeerror, intercepterror, yerr):
     ax.plot(xdata,slope*xdata+intercept,label=f"Fit: y = {slope:.3g}x+{intercept:.3g}")
 
 if __name__ == "__main__":
 
+    import matplotlib.pyplot as plt
+
     N = 1000
     
     lambdas = np.linspace(0.5,20,10)